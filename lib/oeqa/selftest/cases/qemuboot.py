@@ -0,0 +1 @@
+../../../../scripts/qemuboot.py
\ No newline at end of file
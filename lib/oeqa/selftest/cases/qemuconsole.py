@@ -0,0 +1 @@
+../../../../scripts/qemuconsole.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../../../scripts/qemuimage.py
\ No newline at end of file
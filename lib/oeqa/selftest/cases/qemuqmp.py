@@ -0,0 +1 @@
+../../../../scripts/qemuqmp.py
\ No newline at end of file
@@ -1,27 +1,110 @@
+import atexit
+import hashlib
+import json
 import os
 import oe.path
 import logging
+import random
 import re
+import select
+import shutil
 import subprocess
-from time import sleep
+import tempfile
+import threading
+from time import monotonic, sleep, strftime, time
+from uuid import uuid4
 
-from oeqa.utils.commands import runCmd, bitbake, get_bb_var, get_bb_vars
+from oeqa.utils.commands import runCmd, bitbake, get_bb_vars
 from qemucommand import QemuCommand
+from qemuboot import wait_until_ready
+from qemuconsole import SerialConsole
 
 logger = logging.getLogger("selftest")
 
 
+def config_hash():
+    """
+    Hash of the build configuration: every file in conf/, including the
+    fragments written by append_config and bitbake-layers.
+    """
+    confdir = os.path.join(os.environ.get('BUILDDIR', os.getcwd()), 'conf')
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(confdir)):
+        path = os.path.join(confdir, name)
+        if os.path.isfile(path):
+            h.update(name.encode() + b'\0')
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+class BbVarCache(object):
+    """
+    Memoized bitbake variables. The whole environment of a target is read
+    with a single 'bitbake -e' and kept for as long as config_hash() stays
+    the same.
+    """
+
+    def __init__(self):
+        self._envs = {}
+
+    def get_vars(self, variables, target=None):
+        key = (config_hash(), target)
+        if key not in self._envs:
+            # Drop environments of configurations that are no longer current.
+            self._envs = {k: v for k, v in self._envs.items() if k[0] == key[0]}
+            self._envs[key] = get_bb_vars(None, target)
+        env = self._envs[key]
+        return {var: env.get(var) for var in variables}
+
+
+_bb_var_cache = BbVarCache()
+
+
+def cached_bb_vars(variables, target=None):
+    return _bb_var_cache.get_vars(variables, target)
+
+
+def cached_bb_var(var, target=None):
+    return _bb_var_cache.get_vars([var], target)[var]
+
+
 def qemu_launch(efi=False, machine=None, imagename='core-image-minimal', **kwargs):
     qemu_bake_image(imagename)
     return qemu_boot_image(efi=efi, machine=machine, imagename=imagename, **kwargs)
 
 
-def qemu_terminate(s):
+def qemu_terminate(qemu, s, powerdown_timeout=30):
+    """
+    Stop the guest started by qemu_boot_image() and release everything that
+    was set up for it: the console reader and its log, the QMP monitor, the
+    port and checkpoint locks and the SSH master connection.
+
+    The guest is first asked to shut down cleanly through the QMP monitor;
+    QEMU is only killed if it has not exited within 'powerdown_timeout'
+    seconds.
+    """
+    if s.poll() is None and qemu.qmp_socket:
+        try:
+            monitor = qemu.monitor()
+            record_guest_io(monitor.sample(), image=os.path.basename(qemu.image or ''))
+            if monitor.powerdown(powerdown_timeout):
+                s.wait(timeout=10)
+        except Exception as e:
+            logger.debug('Could not power down the guest: %s' % e)
     try:
-        s.terminate()
+        if s.poll() is None:
+            s.terminate()
         s.wait(timeout=10)
     except KeyboardInterrupt:
         pass
+    console = getattr(qemu, 'console', None)
+    if console:
+        console.close()
+    qemu.close_monitor()
+    qemu.release_ports()
+    qemu.release_checkpoint()
+    close_ssh_session(qemu.ssh_port)
 
 
 def qemu_boot_image(imagename, **kwargs):
@@ -36,10 +119,11 @@ def qemu_boot_image(imagename, **kwargs):
     args.bootloader = kwargs.get('bootloader', None)
     args.machine = kwargs.get('machine', None)
     args.mem = kwargs.get('mem', '128M')
-    qemu_use_kvm = get_bb_var("QEMU_USE_KVM")
+    bb_vars = cached_bb_vars(['QEMU_USE_KVM', 'MACHINE'])
+    qemu_use_kvm = bb_vars['QEMU_USE_KVM']
     if qemu_use_kvm and \
             (qemu_use_kvm == 'True' and 'x86' in args.machine or
-             get_bb_var('MACHINE') in qemu_use_kvm.split()):
+             bb_vars['MACHINE'] in qemu_use_kvm.split()):
         args.kvm = True
     else:
         args.kvm = None  # Autodetect
@@ -50,26 +134,343 @@ def qemu_boot_image(imagename, **kwargs):
     args.dry_run = kwargs.get('dry_run', False)
     args.secondary_network = kwargs.get('secondary_network', False)
     args.uboot_enable = kwargs.get('uboot_enable', 'yes')
+    args.checkpoint = kwargs.get('checkpoint', False)
+    args.qmp = os.path.join(tempfile.gettempdir(), 'qemu-qmp-%s.sock' % uuid4().hex[:12])
 
     qemu = QemuCommand(args)
+    if qemu.overlay and not os.path.exists(qemu.overlay):
+        subprocess.check_call(qemu.img_command_line())
     cmdline = qemu.command_line()
-    print('Booting image with run-qemu-ota...')
+    print('Booting image with run-qemu-ota using %s...' % qemu.accelerator)
+    started = monotonic()
     s = subprocess.Popen(cmdline)
-    sleep(kwargs.get('wait_for_boot_time', 10))
+    # Connect to the console and the monitor right away so that no output or
+    # guest event is missed.
+    log_path = os.path.join('tmp', 'log', 'qemu', '%s-%s-%d.log' % (imagename, strftime('%Y%m%d%H%M%S'),
+                                                                    qemu.ssh_port))
+    qemu.console = SerialConsole(qemu.serial_port, log_path=log_path, started=started)
+    logger.info('Logging serial console to %s' % log_path)
+    monitor = None
+    try:
+        monitor = qemu.monitor()
+    except Exception as e:
+        logger.warning('Could not connect to the QMP monitor: %s' % e)
+    # Wait until sshd in the guest answers rather than for a fixed time.
+    qemu.boot_timeline = wait_until_ready(qemu, s, timeout=kwargs.get('boot_timeout', 300), started=started,
+                                          console=qemu.console, monitor=monitor)
+    if qemu.boot_timeline.ready:
+        logger.info('Guest booted: %s' % qemu.boot_timeline)
+        if qemu.checkpoint and not qemu.loadvm:
+            try:
+                qemu.save_checkpoint()
+            except Exception as e:
+                logger.warning('Could not save boot checkpoint: %s' % e)
+    else:
+        logger.warning('Guest did not become reachable over SSH: %s\nLast console lines:\n%s' %
+                       (qemu.boot_timeline, qemu.console.excerpt()))
     return qemu, s
 
 
+class VmFixtures(object):
+    """
+    Session-wide registry of booted guests. Each distinct configuration
+    (config_hash() plus the boot options) is baked only once, and a guest
+    is handed to the next test with the same configuration instead of being
+    torn down. Only the most recently used guest is kept running.
+
+    Where possible guests are started from a post-boot checkpoint and reset
+    by reverting to it, without restarting QEMU.
+    """
+
+    def __init__(self):
+        self._baked = set()
+        self._vms = {}
+
+    def acquire(self, imagename='core-image-minimal', **kwargs):
+        if kwargs.get('uboot_enable', 'yes') == 'yes' and not kwargs.get('efi'):
+            kwargs.setdefault('checkpoint', True)
+        key = hashlib.sha256(repr((config_hash(), imagename, sorted(kwargs.items()))).encode()).hexdigest()
+        if key not in self._baked:
+            qemu_bake_image(imagename)
+            self._baked.add(key)
+        for other in [k for k in self._vms if k != key]:
+            self._terminate(*self._vms.pop(other))
+        if key in self._vms:
+            qemu, s = self._reset(key, imagename, **kwargs)
+        else:
+            qemu, s = qemu_boot_image(imagename=imagename, **kwargs)
+        self._vms[key] = (qemu, s)
+        return qemu, s
+
+    def _reset(self, key, imagename, **kwargs):
+        qemu, s = self._vms.pop(key)
+        if qemu.loadvm and s.poll() is None:
+            try:
+                started = monotonic()
+                qemu.restore_checkpoint()
+                # The SSH master's connection did not survive the revert.
+                close_ssh_session(qemu.ssh_port)
+                qemu.boot_timeline = wait_until_ready(qemu, s, timeout=kwargs.get('boot_timeout', 300),
+                                                      started=started, console=qemu.console,
+                                                      monitor=qemu.monitor())
+                if qemu.boot_timeline.ready:
+                    return qemu, s
+            except Exception as e:
+                logger.warning('Could not revert guest to its checkpoint: %s' % e)
+        # Otherwise restart it. Guests without a checkpoint run on a
+        # throw-away snapshot of the image, so this brings back the pristine
+        # disk too.
+        self._terminate(qemu, s)
+        return qemu_boot_image(imagename=imagename, **kwargs)
+
+    def _terminate(self, qemu, s):
+        qemu_terminate(qemu, s)
+
+    def terminate_all(self):
+        for qemu, s in self._vms.values():
+            self._terminate(qemu, s)
+        self._vms.clear()
+
+
+_vm_fixtures = VmFixtures()
+atexit.register(_vm_fixtures.terminate_all)
+
+
+def qemu_fixture(efi=False, machine=None, imagename='core-image-minimal', **kwargs):
+    """
+    Like qemu_launch(), but shares the guest with other tests that use the
+    same configuration. The guest must not be terminated by the caller.
+    """
+    return _vm_fixtures.acquire(efi=efi, machine=machine, imagename=imagename, **kwargs)
+
+
+def qemu_wait_for_reboot(qemu, s, timeout=300):
+    """
+    Block until the guest resets, e.g. after installing an update with
+    auto-reboot enabled, and is reachable over SSH again. Call
+    qemu.monitor().clear_events() before triggering the reboot so that an
+    earlier reset is not mistaken for it. Returns whether the guest came
+    back.
+    """
+    started = monotonic()
+    try:
+        if qemu.monitor().wait_for_event('RESET', timeout) is None:
+            raise Exception('QMP connection closed')
+    except Exception as e:
+        logger.warning('Guest did not reboot: %s' % e)
+        return False
+    # The SSH master's connection did not survive the reboot.
+    close_ssh_session(qemu.ssh_port)
+    qemu.boot_timeline = wait_until_ready(qemu, s, timeout=max(0, timeout - (monotonic() - started)),
+                                          started=started, console=qemu.console, monitor=qemu.monitor())
+    return qemu.boot_timeline.ready
+
+
+def qemu_reboot(qemu, s, timeout=300):
+    """
+    Reboot the guest from inside and wait until it is back, see
+    qemu_wait_for_reboot().
+    """
+    qemu.monitor().clear_events()
+    try:
+        # The connection may drop before the command returns.
+        qemu_send_command(qemu.ssh_port, 'systemctl reboot', timeout=30)
+    except subprocess.TimeoutExpired:
+        pass
+    return qemu_wait_for_reboot(qemu, s, timeout)
+
+
 def qemu_bake_image(imagename):
     logger.info('Running bitbake to build {}'.format(imagename))
     bitbake(imagename)
 
 
+SSH_OPTIONS = ['-q', '-o', 'UserKnownHostsFile=/dev/null', '-o', 'StrictHostKeyChecking=no']
+
+
+class SshSession(object):
+    """
+    OpenSSH ControlMaster connection to a guest. Commands sent through it
+    reuse the master's TCP connection and key exchange instead of opening a
+    new one each time.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.control_dir = tempfile.mkdtemp(prefix='qemu-ssh-')
+        self.control_path = os.path.join(self.control_dir, 'master.sock')
+
+    def _ssh(self, *args):
+        return ['ssh'] + SSH_OPTIONS + ['-o', 'ControlPath=' + self.control_path,
+                                        '-p', str(self.port)] + list(args)
+
+    def _start_master(self, timeout):
+        # The master forks into the background once authenticated. Its stdio
+        # goes to /dev/null so it can not hold our pipes open.
+        cmdline = self._ssh('-M', '-N', '-f', '-o', 'ControlPersist=no', 'root@localhost')
+        try:
+            subprocess.run(cmdline, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logger.debug('Could not start SSH master for port %d' % self.port)
+
+    def run(self, command, timeout=120):
+        # The master removes its socket when the connection goes away, e.g.
+        # when the guest reboots. If it can not be (re)started, ssh falls back
+        # to a direct connection.
+        if not os.path.exists(self.control_path):
+            self._start_master(timeout)
+        cmdline = self._ssh('-o', 'ControlMaster=no', 'root@localhost', command)
+        s2 = subprocess.Popen(cmdline, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            stdout, stderr = s2.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            s2.kill()
+            s2.communicate()
+            raise
+        return stdout, stderr, s2.returncode
+
+    def follow(self, command, pattern, timeout, stop=None):
+        """
+        Run 'command' (e.g. 'journalctl -f') and return the first line of its
+        output that matches the regular expression 'pattern', or None if none
+        does within 'timeout' seconds, the command exits first or 'stop' (a
+        threading.Event) is set.
+        """
+        if not os.path.exists(self.control_path):
+            self._start_master(min(timeout, 120))
+        cmdline = self._ssh('-o', 'ControlMaster=no', 'root@localhost', command)
+        s2 = subprocess.Popen(cmdline, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        pattern = re.compile(pattern)
+        deadline = monotonic() + timeout
+        pending = b''
+        try:
+            while True:
+                remaining = deadline - monotonic()
+                if remaining <= 0 or (stop is not None and stop.is_set()):
+                    return None
+                readable, _, _ = select.select([s2.stdout], [], [], min(remaining, 0.5))
+                if not readable:
+                    continue
+                data = os.read(s2.stdout.fileno(), 65536)
+                if not data:
+                    return None
+                *lines, pending = (pending + data).split(b'\n')
+                for line in lines:
+                    line = line.decode(errors='replace')
+                    if pattern.search(line):
+                        return line
+        finally:
+            s2.kill()
+            s2.wait()
+            s2.stdout.close()
+
+    def close(self):
+        if os.path.exists(self.control_path):
+            subprocess.call(self._ssh('-O', 'exit', 'root@localhost'),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+
+_ssh_sessions = {}
+
+
+def ssh_session(port):
+    if port not in _ssh_sessions:
+        _ssh_sessions[port] = SshSession(port)
+    return _ssh_sessions[port]
+
+
+def close_ssh_session(port):
+    session = _ssh_sessions.pop(port, None)
+    if session:
+        session.close()
+
+
+def close_ssh_sessions():
+    for session in _ssh_sessions.values():
+        session.close()
+    _ssh_sessions.clear()
+
+
+atexit.register(close_ssh_sessions)
+
+
 def qemu_send_command(port, command, timeout=120):
-    command = ['ssh -q -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no root@localhost -p ' +
-               str(port) + ' "' + command + '"']
-    s2 = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = s2.communicate(timeout=timeout)
-    return stdout, stderr, s2.returncode
+    return ssh_session(port).run(command, timeout=timeout)
+
+
+def qemu_wait_for_boot_complete(testInst, port, timeout=300):
+    """
+    Block until systemd in the guest has finished starting up, i.e. every
+    unit of the default target (multi-user.target) was started or failed,
+    and fail the test if it does not within 'timeout' seconds. sshd answers
+    well before that.
+    """
+    stdout, stderr, retcode = qemu_send_command(port, 'timeout %d systemctl is-system-running --wait' % timeout,
+                                                timeout=timeout + 30)
+    state = stdout.decode().strip()
+    testInst.assertIn(state, ['running', 'degraded'],
+                      'Guest did not finish booting: ' + stderr.decode() + stdout.decode())
+    return state
+
+
+def qemu_follow_journal(port, pattern, timeout, unit='aktualizr', stop=None):
+    """
+    Tail the journal of 'unit' in the guest, from its first entry, until a
+    message matches 'pattern'. Returns the message, or None on timeout, when
+    'stop' is set or if the guest has no journal.
+    """
+    return ssh_session(port).follow('journalctl --follow --lines=all --output=cat --unit=%s' % unit,
+                                    pattern, timeout, stop)
+
+
+def poll_with_backoff(function, done, timeout, initial=1.0, factor=2.0, max_delay=16.0, wake=None):
+    """
+    Call 'function' until 'done' is true for its result or 'timeout' seconds
+    have passed, sleeping with exponential backoff and jitter in between.
+    When 'wake' (a threading.Event) is set, 'function' is called right away
+    and the backoff starts over from 'initial'. Returns the last result.
+    """
+    deadline = monotonic() + timeout
+    delay = initial
+    while True:
+        result = function()
+        remaining = deadline - monotonic()
+        if done(result) or remaining <= 0:
+            return result
+        pause = min(remaining, random.uniform(delay / 2, delay))
+        delay = min(delay * factor, max_delay)
+        if wake is None:
+            sleep(pause)
+        elif wake.wait(pause):
+            delay = initial
+            wake = None
+
+
+METRICS_LOG = os.path.join('tmp', 'log', 'selftest-metrics.jsonl')
+
+
+def record_metric(name, value, **labels):
+    """
+    Append a measurement to METRICS_LOG, one JSON object per line, so that
+    it can be trended across runs.
+    """
+    entry = {'metric': name, 'value': value, 'time': time()}
+    entry.update(labels)
+    os.makedirs(os.path.dirname(METRICS_LOG), exist_ok=True)
+    with open(METRICS_LOG, 'a') as f:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+    logger.info('%s: %s' % (name, value))
+
+
+def record_guest_io(sample, **labels):
+    """
+    Record the block I/O totals of a QmpMonitor.sample().
+    """
+    stats = [device['stats'] for device in sample['blockstats']]
+    record_metric('guest_read_bytes', sum(st.get('rd_bytes', 0) for st in stats), **labels)
+    record_metric('guest_written_bytes', sum(st.get('wr_bytes', 0) for st in stats), **labels)
 
 
 def metadir():
@@ -82,6 +483,24 @@ def metadir():
     return metadir
 
 
+def add_layer(layer):
+    """
+    Add 'layer' from metadir() unless it is already configured. Returns the
+    path that was added, to be passed to remove_layer(), or None.
+    """
+    result = runCmd('bitbake-layers show-layers')
+    if re.search(layer, result.output) is not None:
+        return None
+    path = metadir() + layer
+    runCmd('bitbake-layers add-layer "%s"' % path)
+    return path
+
+
+def remove_layer(path):
+    if path:
+        runCmd('bitbake-layers remove-layer "%s"' % path, ignore_status=True)
+
+
 def akt_native_run(testInst, cmd, **kwargs):
     # run a command supplied by aktualizr-native and checks that:
     # - the executable exists
@@ -92,23 +511,24 @@ def akt_native_run(testInst, cmd, **kwargs):
     #   bitbake build-sysroots -c build_native_sysroot
     #
     # (technique found in poky/meta/lib/oeqa/selftest/cases/package.py)
-    bb_vars = get_bb_vars(['STAGING_DIR', 'BUILD_ARCH'])
+    bb_vars = cached_bb_vars(['STAGING_DIR', 'BUILD_ARCH'])
     sysroot = oe.path.join(bb_vars['STAGING_DIR'], bb_vars['BUILD_ARCH'])
 
     result = runCmd(cmd, native_sysroot=sysroot, ignore_status=True, **kwargs)
     testInst.assertEqual(result.status, 0, "Status not equal to 0. output: %s" % result.output)
 
 
-def verifyNotProvisioned(testInst, machine):
+def aktualizr_info_ok(result):
+    stdout, stderr, retcode = result
+    return retcode == 0 and stderr == b''
+
+
+def verifyNotProvisioned(testInst, machine, timeout=60):
     print('Checking output of aktualizr-info:')
-    ran_ok = False
-    for delay in [5, 5, 5, 5, 10, 10, 10, 10]:
-        stdout, stderr, retcode = testInst.qemu_command('aktualizr-info')
-        if retcode == 0 and stderr == b'':
-            ran_ok = True
-            break
-        sleep(delay)
-    testInst.assertTrue(ran_ok, 'aktualizr-info failed: ' + stderr.decode() + stdout.decode())
+    stdout, stderr, retcode = poll_with_backoff(lambda: testInst.qemu_command('aktualizr-info'),
+                                                aktualizr_info_ok, timeout)
+    testInst.assertTrue(aktualizr_info_ok((stdout, stderr, retcode)),
+                        'aktualizr-info failed: ' + stderr.decode() + stdout.decode())
 
     # Verify that device has NOT yet provisioned.
     testInst.assertIn(b'Couldn\'t load device ID', stdout,
@@ -121,17 +541,41 @@ def verifyNotProvisioned(testInst, machine):
                       'Device already provisioned!? ' + stderr.decode() + stdout.decode())
 
 
-def verifyProvisioned(testInst, machine, hwid=''):
+# aktualizr's message on success only; failures log e.g. "Device was not
+# provisioned".
+PROVISIONED_JOURNAL_RE = r'Provisioned successfully'
+
+
+def aktualizr_info_provisioned(result):
+    return aktualizr_info_ok(result) and b'Fetched metadata: yes' in result[0]
+
+
+def verifyProvisioned(testInst, machine, hwid='', timeout=300):
     # Verify that device HAS provisioned.
-    # First loop while waiting for the device to boot.
-    ran_ok = False
-    for delay in [5, 5, 5, 5, 10, 10, 10, 10]:
-        stdout, stderr, retcode = testInst.qemu_command('aktualizr-info')
-        if retcode == 0 and stderr == b'':
-            ran_ok = True
-            break
-        sleep(delay)
-    testInst.assertTrue(ran_ok, 'aktualizr-info failed: ' + stderr.decode() + stdout.decode())
+    started = monotonic()
+    qemu = getattr(testInst, 'qemu', None)
+    provisioned = threading.Event()
+    stop = threading.Event()
+    follower = None
+    if qemu is not None:
+        # Poll aktualizr-info right away once aktualizr logs it has
+        # provisioned, rather than at the next poll.
+        def follow():
+            line = qemu_follow_journal(qemu.ssh_port, PROVISIONED_JOURNAL_RE, timeout, stop=stop)
+            logger.debug('aktualizr journal: %s' % line)
+            if line is not None:
+                provisioned.set()
+        follower = threading.Thread(target=follow, daemon=True)
+        follower.start()
+    try:
+        stdout, stderr, retcode = poll_with_backoff(lambda: testInst.qemu_command('aktualizr-info'),
+                                                    aktualizr_info_provisioned, timeout, wake=provisioned)
+    finally:
+        stop.set()
+        if follower is not None:
+            follower.join()
+    testInst.assertTrue(aktualizr_info_ok((stdout, stderr, retcode)),
+                        'aktualizr-info failed: ' + stderr.decode() + stdout.decode())
     # Then wait for aktualizr to provision.
     if stdout.decode().find('Fetched metadata: yes') < 0:
         stdout, stderr, retcode = testInst.qemu_command('aktualizr-info --wait-until-provisioned')
@@ -150,5 +594,9 @@ def verifyProvisioned(testInst, machine, hwid=''):
     testInst.assertTrue(m, 'Device ID could not be read: ' + stderr.decode() + stdout.decode())
     testInst.assertGreater(m.lastindex, 0, 'Device ID could not be read: ' + stderr.decode() + stdout.decode())
     logger.info('Device successfully provisioned with ID: ' + m.group(1))
+    boot_timeline = getattr(qemu, 'boot_timeline', None)
+    record_metric('provisioning_wait_seconds', round(monotonic() - started, 3), test=testInst.id())
+    if boot_timeline is not None:
+        record_metric('provisioning_seconds', round(monotonic() - boot_timeline.started, 3), test=testInst.id())
 
 # vim:set ts=4 sw=4 sts=4 expandtab:
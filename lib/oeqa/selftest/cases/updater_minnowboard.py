@@ -1,37 +1,21 @@
-import re
-
 from oeqa.selftest.case import OESelftestTestCase
-from oeqa.utils.commands import runCmd, get_bb_var
-from testutils import metadir, qemu_launch, qemu_send_command, qemu_terminate, verifyProvisioned
+from testutils import add_layer, remove_layer, qemu_fixture, qemu_send_command, verifyProvisioned, \
+    cached_bb_var
 
 
 class MinnowTests(OESelftestTestCase):
 
     def setUpLocal(self):
-        layer_intel = "meta-intel"
-        layer_minnow = "meta-updater-minnowboard"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer_intel, result.output) is None:
-            self.meta_intel = metadir() + layer_intel
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_intel)
-        else:
-            self.meta_intel = None
-        if re.search(layer_minnow, result.output) is None:
-            self.meta_minnow = metadir() + layer_minnow
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_minnow)
-        else:
-            self.meta_minnow = None
+        self.meta_intel = add_layer("meta-intel")
+        self.meta_minnow = add_layer("meta-updater-minnowboard")
         self.append_config('MACHINE = "intel-corei7-64"')
         self.append_config('OSTREE_BOOTLOADER = "grub"')
         self.append_config('SOTA_CLIENT_PROV = " aktualizr-shared-prov "')
-        self.qemu, self.s = qemu_launch(efi=True, machine='intel-corei7-64', mem='512M')
+        self.qemu, self.s = qemu_fixture(efi=True, machine='intel-corei7-64', mem='512M')
 
     def tearDownLocal(self):
-        qemu_terminate(self.s)
-        if self.meta_intel:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_intel, ignore_status=True)
-        if self.meta_minnow:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_minnow, ignore_status=True)
+        remove_layer(self.meta_intel)
+        remove_layer(self.meta_minnow)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -41,7 +25,7 @@ class MinnowTests(OESelftestTestCase):
         stdout, stderr, retcode = self.qemu_command('hostname')
         self.assertEqual(retcode, 0, "Unable to check hostname. " +
                          "Is an ssh daemon (such as dropbear or openssh) installed on the device?")
-        machine = get_bb_var('MACHINE', 'core-image-minimal')
+        machine = cached_bb_var('MACHINE', 'core-image-minimal')
         self.assertEqual(stderr, b'', 'Error: ' + stderr.decode())
         # Strip off line ending.
         value = stdout.decode()[:-1]
@@ -8,10 +8,10 @@ from time import sleep
 from uuid import uuid4
 
 from oeqa.selftest.case import OESelftestTestCase
-from oeqa.utils.commands import runCmd, bitbake, get_bb_var, get_bb_vars
-from testutils import qemu_launch, qemu_send_command, qemu_terminate, \
-    metadir, akt_native_run, verifyNotProvisioned, verifyProvisioned, \
-    qemu_bake_image, qemu_boot_image
+from oeqa.utils.commands import runCmd, bitbake
+from testutils import qemu_fixture, qemu_send_command, qemu_terminate, qemu_wait_for_boot_complete, qemu_reboot, \
+    add_layer, remove_layer, akt_native_run, verifyNotProvisioned, verifyProvisioned, \
+    qemu_bake_image, qemu_boot_image, cached_bb_var, cached_bb_vars
 
 
 class GeneralTests(OESelftestTestCase):
@@ -23,14 +23,14 @@ class GeneralTests(OESelftestTestCase):
         # note: this also tests ostreepush/garagesign/garagecheck which are
         # omitted from other test cases
         bitbake('core-image-minimal')
-        credentials = get_bb_var('SOTA_PACKED_CREDENTIALS')
+        credentials = cached_bb_var('SOTA_PACKED_CREDENTIALS')
         # skip the test if the variable SOTA_PACKED_CREDENTIALS is not set
         if credentials is None:
             raise unittest.SkipTest("Variable 'SOTA_PACKED_CREDENTIALS' not set.")
         # Check if the file exists
         self.assertTrue(os.path.isfile(credentials), "File %s does not exist" % credentials)
-        deploydir = get_bb_var('DEPLOY_DIR_IMAGE')
-        imagename = get_bb_var('IMAGE_LINK_NAME', 'core-image-minimal')
+        deploydir = cached_bb_var('DEPLOY_DIR_IMAGE')
+        imagename = cached_bb_var('IMAGE_LINK_NAME', 'core-image-minimal')
         # Check if the credentials are included in the output image
         result = runCmd('tar -jtvf %s/%s.tar.bz2 | grep sota_provisioning_credentials.zip' %
                         (deploydir, imagename), ignore_status=True)
@@ -51,10 +51,10 @@ class AktualizrToolsTests(OESelftestTestCase):
         akt_native_run(self, 'aktualizr-cert-provider --help')
 
     def test_cert_provider_local_output(self):
-        bb_vars = get_bb_vars(['SOTA_PACKED_CREDENTIALS', 'T'], 'aktualizr-native')
+        bb_vars = cached_bb_vars(['SOTA_PACKED_CREDENTIALS', 'T'], 'aktualizr-native')
         creds = bb_vars['SOTA_PACKED_CREDENTIALS']
         temp_dir = bb_vars['T']
-        bb_vars_prov = get_bb_vars(['WORKDIR', 'libdir'], 'aktualizr-device-prov')
+        bb_vars_prov = cached_bb_vars(['WORKDIR', 'libdir'], 'aktualizr-device-prov')
         config = bb_vars_prov['WORKDIR'] + '/sysroot-destdir' + bb_vars_prov['libdir'] + '/sota/conf.d/20-sota-device-cred.toml'
 
         akt_native_run(self, 'aktualizr-cert-provider -c {creds} -r -l {temp} -g {config}'
@@ -75,23 +75,15 @@ class AktualizrToolsTests(OESelftestTestCase):
 class SharedCredProvTests(OESelftestTestCase):
 
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        self.meta_qemu = add_layer("meta-updater-qemux86-64")
         self.append_config('MACHINE = "qemux86-64"')
         self.append_config('SOTA_CLIENT_PROV = " aktualizr-shared-prov "')
         self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
         self.append_config('SOTA_HARDWARE_ID = "plain_reibekuchen_314"')
-        self.qemu, self.s = qemu_launch(machine='qemux86-64')
+        self.qemu, self.s = qemu_fixture(machine='qemux86-64')
 
     def tearDownLocal(self):
-        qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
+        remove_layer(self.meta_qemu)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -101,27 +93,34 @@ class SharedCredProvTests(OESelftestTestCase):
         stdout, stderr, retcode = self.qemu_command('hostname')
         self.assertEqual(retcode, 0, "Unable to check hostname. " +
                          "Is an ssh daemon (such as dropbear or openssh) installed on the device?")
-        machine = get_bb_var('MACHINE', 'core-image-minimal')
+        machine = cached_bb_var('MACHINE', 'core-image-minimal')
         self.assertEqual(stderr, b'', 'Error: ' + stderr.decode())
         # Strip off line ending.
         value = stdout.decode()[:-1]
         self.assertEqual(value, machine,
                          'MACHINE does not match hostname: ' + machine + ', ' + value)
 
-        hwid = get_bb_var('SOTA_HARDWARE_ID')
+        hwid = cached_bb_var('SOTA_HARDWARE_ID')
+        verifyProvisioned(self, machine, hwid)
+
+    def test_provisioning_survives_reboot(self):
+        machine = cached_bb_var('MACHINE', 'core-image-minimal')
+        hwid = cached_bb_var('SOTA_HARDWARE_ID')
         verifyProvisioned(self, machine, hwid)
+        stdout, stderr, retcode = self.qemu_command('aktualizr-info')
+        device_id = re.search(r'Device ID: ([a-z0-9-]*)\n', stdout.decode())
+
+        self.assertTrue(qemu_reboot(self.qemu, self.s), 'Guest did not come back after reboot: %s' %
+                        self.qemu.boot_timeline)
+        verifyProvisioned(self, machine, hwid)
+        stdout, stderr, retcode = self.qemu_command('aktualizr-info')
+        self.assertIn(device_id.group(0).encode(), stdout, 'Device ID changed across reboot: ' + stdout.decode())
 
 
 class SharedCredProvTestsNonOSTree(SharedCredProvTests):
 
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        self.meta_qemu = add_layer("meta-updater-qemux86-64")
         self.append_config('MACHINE = "qemux86-64"')
         self.append_config('SOTA_CLIENT_PROV = ""')
         self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
@@ -134,29 +133,21 @@ class SharedCredProvTestsNonOSTree(SharedCredProvTests):
         self.append_config('PACKAGECONFIG:pn-aktualizr = ""')
         self.append_config('SOTA_DEPLOY_CREDENTIALS = "1"')
         self.append_config('IMAGE_INSTALL:append += "aktualizr aktualizr-info aktualizr-shared-prov"')
-        self.qemu, self.s = qemu_launch(machine='qemux86-64', uboot_enable='no')
+        self.qemu, self.s = qemu_fixture(machine='qemux86-64', uboot_enable='no')
 
 
 class ManualControlTests(OESelftestTestCase):
 
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        self.meta_qemu = add_layer("meta-updater-qemux86-64")
         self.append_config('MACHINE = "qemux86-64"')
         self.append_config('SOTA_CLIENT_PROV = " aktualizr-shared-prov "')
         self.append_config('SYSTEMD_AUTO_ENABLE:aktualizr = "disable"')
         self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
-        self.qemu, self.s = qemu_launch(machine='qemux86-64')
+        self.qemu, self.s = qemu_fixture(machine='qemux86-64')
 
     def tearDownLocal(self):
-        qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
+        remove_layer(self.meta_qemu)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -165,7 +156,9 @@ class ManualControlTests(OESelftestTestCase):
         """
         Disable the systemd service then run aktualizr manually
         """
-        sleep(20)
+        # Only once systemd is done starting units does the absence of a
+        # database show that the service stayed disabled.
+        qemu_wait_for_boot_complete(self, self.qemu.ssh_port)
         stdout, stderr, retcode = self.qemu_command('aktualizr-info')
         self.assertIn(b'Can\'t open database', stderr,
                       'Aktualizr should not have run yet' + stderr.decode() + stdout.decode())
@@ -180,24 +173,16 @@ class ManualControlTests(OESelftestTestCase):
 class DeviceCredProvTests(OESelftestTestCase):
 
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        self.meta_qemu = add_layer("meta-updater-qemux86-64")
         self.append_config('MACHINE = "qemux86-64"')
         self.append_config('SOTA_CLIENT_PROV = " aktualizr-device-prov "')
         self.append_config('SOTA_DEPLOY_CREDENTIALS = "0"')
         self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
-        self.qemu, self.s = qemu_launch(machine='qemux86-64')
+        self.qemu, self.s = qemu_fixture(machine='qemux86-64')
         bitbake('build-sysroots -c build_native_sysroot')
 
     def tearDownLocal(self):
-        qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
+        remove_layer(self.meta_qemu)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -207,7 +192,7 @@ class DeviceCredProvTests(OESelftestTestCase):
         stdout, stderr, retcode = self.qemu_command('hostname')
         self.assertEqual(retcode, 0, "Unable to check hostname. " +
                          "Is an ssh daemon (such as dropbear or openssh) installed on the device?")
-        machine = get_bb_var('MACHINE', 'core-image-minimal')
+        machine = cached_bb_var('MACHINE', 'core-image-minimal')
         self.assertEqual(stderr, b'', 'Error: ' + stderr.decode())
         # Strip off line ending.
         value = stdout.decode()[:-1]
@@ -217,9 +202,9 @@ class DeviceCredProvTests(OESelftestTestCase):
         verifyNotProvisioned(self, machine)
 
         # Run aktualizr-cert-provider.
-        bb_vars = get_bb_vars(['SOTA_PACKED_CREDENTIALS'], 'aktualizr-native')
+        bb_vars = cached_bb_vars(['SOTA_PACKED_CREDENTIALS'], 'aktualizr-native')
         creds = bb_vars['SOTA_PACKED_CREDENTIALS']
-        bb_vars_prov = get_bb_vars(['WORKDIR', 'libdir'], 'aktualizr-device-prov')
+        bb_vars_prov = cached_bb_vars(['WORKDIR', 'libdir'], 'aktualizr-device-prov')
         config = bb_vars_prov['WORKDIR'] + '/sysroot-destdir' + bb_vars_prov['libdir'] + '/sota/conf.d/20-sota-device-cred.toml'
 
         print('Provisining at root@localhost:%d' % self.qemu.ssh_port)
@@ -232,26 +217,18 @@ class DeviceCredProvTests(OESelftestTestCase):
 class DeviceCredProvHsmTests(OESelftestTestCase):
 
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        self.meta_qemu = add_layer("meta-updater-qemux86-64")
         self.append_config('MACHINE = "qemux86-64"')
         self.append_config('SOTA_CLIENT_PROV = "aktualizr-device-prov-hsm"')
         self.append_config('SOTA_DEPLOY_CREDENTIALS = "0"')
         self.append_config('SOTA_CLIENT_FEATURES = "hsm"')
         self.append_config('IMAGE_INSTALL:append = " softhsm-testtoken"')
         self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
-        self.qemu, self.s = qemu_launch(machine='qemux86-64')
+        self.qemu, self.s = qemu_fixture(machine='qemux86-64')
         bitbake('build-sysroots -c build_native_sysroot')
 
     def tearDownLocal(self):
-        qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
+        remove_layer(self.meta_qemu)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -261,7 +238,7 @@ class DeviceCredProvHsmTests(OESelftestTestCase):
         stdout, stderr, retcode = self.qemu_command('hostname')
         self.assertEqual(retcode, 0, "Unable to check hostname. " +
                          "Is an ssh daemon (such as dropbear or openssh) installed on the device?")
-        machine = get_bb_var('MACHINE', 'core-image-minimal')
+        machine = cached_bb_var('MACHINE', 'core-image-minimal')
         self.assertEqual(stderr, b'', 'Error: ' + stderr.decode())
         # Strip off line ending.
         value = stdout.decode()[:-1]
@@ -281,9 +258,9 @@ class DeviceCredProvHsmTests(OESelftestTestCase):
                             stdout.decode() + stderr.decode())
 
         # Run aktualizr-cert-provider.
-        bb_vars = get_bb_vars(['SOTA_PACKED_CREDENTIALS'], 'aktualizr-native')
+        bb_vars = cached_bb_vars(['SOTA_PACKED_CREDENTIALS'], 'aktualizr-native')
         creds = bb_vars['SOTA_PACKED_CREDENTIALS']
-        bb_vars_prov = get_bb_vars(['WORKDIR', 'libdir'], 'aktualizr-device-prov-hsm')
+        bb_vars_prov = cached_bb_vars(['WORKDIR', 'libdir'], 'aktualizr-device-prov-hsm')
         config = bb_vars_prov['WORKDIR'] + '/sysroot-destdir' + bb_vars_prov['libdir'] + '/sota/conf.d/20-sota-device-cred-hsm.toml'
 
         akt_native_run(self, 'aktualizr-cert-provider -c {creds} -t root@localhost -p {port} -r -s -u -g {config}'
@@ -347,12 +324,12 @@ class IpSecondaryTests(OESelftestTestCase):
 
         def __enter__(self):
             self.qemu, self.process = qemu_boot_image(machine=self.machine, imagename=self.imagename,
-                                                      wait_for_boot_time=1, **self.boot_kwargs)
+                                                      **self.boot_kwargs)
             # wait until the VM is booted and is SSHable
             self.wait_till_sshable()
 
         def __exit__(self, exc_type, exc_val, exc_tb):
-            qemu_terminate(self.process)
+            qemu_terminate(self.qemu, self.process)
 
         def wait_till_sshable(self):
             # qemu_send_command tries to ssh into the qemu VM and blocks until it gets there or timeout happens
@@ -399,21 +376,14 @@ class IpSecondaryTests(OESelftestTestCase):
             return stdout
 
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        self.meta_qemu = add_layer("meta-updater-qemux86-64")
 
         self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
         self.primary = IpSecondaryTests.Primary(self)
         self.secondary = IpSecondaryTests.Secondary(self)
 
     def tearDownLocal(self):
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
+        remove_layer(self.meta_qemu)
 
     def test_ip_secondary_registration_if_secondary_starts_first(self):
         with self.secondary:
@@ -442,13 +412,7 @@ class IpSecondaryTests(OESelftestTestCase):
 
 class ResourceControlTests(OESelftestTestCase):
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        self.meta_qemu = add_layer("meta-updater-qemux86-64")
         self.append_config('MACHINE = "qemux86-64"')
         self.append_config('SOTA_CLIENT_PROV = " aktualizr-shared-prov "')
         self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
@@ -456,12 +420,10 @@ class ResourceControlTests(OESelftestTestCase):
         self.append_config('RESOURCE_CPU_WEIGHT:pn-aktualizr = "1000"')
         self.append_config('RESOURCE_MEMORY_HIGH:pn-aktualizr = "50M"')
         self.append_config('RESOURCE_MEMORY_MAX:pn-aktualizr = "1M"')
-        self.qemu, self.s = qemu_launch(machine='qemux86-64')
+        self.qemu, self.s = qemu_fixture(machine='qemux86-64')
 
     def tearDownLocal(self):
-        qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
+        remove_layer(self.meta_qemu)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -493,24 +455,16 @@ class ResourceControlTests(OESelftestTestCase):
 
 class NonSystemdTests(OESelftestTestCase):
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        self.meta_qemu = add_layer("meta-updater-qemux86-64")
         self.append_config('MACHINE = "qemux86-64"')
         self.append_config('SOTA_CLIENT_PROV = " aktualizr-shared-prov "')
         self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
         self.append_config('DISTRO = "poky-sota"')
         self.append_config('IMAGE_INSTALL:remove += " aktualizr-resource-control"')
-        self.qemu, self.s = qemu_launch(machine='qemux86-64')
+        self.qemu, self.s = qemu_fixture(machine='qemux86-64')
 
     def tearDownLocal(self):
-        qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
+        remove_layer(self.meta_qemu)
 
     def qemu_command(self, command):
         return qemu_send_command(self.qemu.ssh_port, command)
@@ -523,7 +477,7 @@ class NonSystemdTests(OESelftestTestCase):
         stdout, stderr, retcode = self.qemu_command('aktualizr --run-mode once')
         self.assertEqual(retcode, 0, 'Failed to run aktualizr: ' + str(stdout) + str(stderr))
 
-        machine = get_bb_var('MACHINE', 'core-image-minimal')
+        machine = cached_bb_var('MACHINE', 'core-image-minimal')
         verifyProvisioned(self, machine)
 
 # vim:set ts=4 sw=4 sts=4 expandtab:
@@ -2,31 +2,22 @@
 import re
 
 from oeqa.selftest.case import OESelftestTestCase
-from oeqa.utils.commands import runCmd
-from testutils import metadir, qemu_launch, qemu_send_command, qemu_terminate
+from testutils import add_layer, remove_layer, qemu_fixture, qemu_send_command
 
 
 class PtestTests(OESelftestTestCase):
 
     def setUpLocal(self):
-        layer = "meta-updater-qemux86-64"
-        result = runCmd('bitbake-layers show-layers')
-        if re.search(layer, result.output) is None:
-            self.meta_qemu = metadir() + layer
-            runCmd('bitbake-layers add-layer "%s"' % self.meta_qemu)
-        else:
-            self.meta_qemu = None
+        self.meta_qemu = add_layer("meta-updater-qemux86-64")
         self.append_config('MACHINE = "qemux86-64"')
         self.append_config('SYSTEMD_AUTO_ENABLE:aktualizr = "disable"')
         self.append_config('PTEST_ENABLED:pn-aktualizr = "1"')
         self.append_config('IMAGE_INSTALL:append += "aktualizr-ptest ptest-runner "')
         self.append_config('IMAGE_FSTYPES:remove = "ostreepush garagesign garagecheck"')
-        self.qemu, self.s = qemu_launch(machine='qemux86-64', mem="768M")
+        self.qemu, self.s = qemu_fixture(machine='qemux86-64', mem="768M")
 
     def tearDownLocal(self):
-        qemu_terminate(self.s)
-        if self.meta_qemu:
-            runCmd('bitbake-layers remove-layer "%s"' % self.meta_qemu, ignore_status=True)
+        remove_layer(self.meta_qemu)
 
     def qemu_command(self, command, timeout=60):
         return qemu_send_command(self.qemu.ssh_port, command, timeout=timeout)
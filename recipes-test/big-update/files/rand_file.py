@@ -1,16 +1,270 @@
+import argparse
+import hashlib
+import json
+import random
 import sys
-from random import seed, randint
+
+CHUNK_SIZE = 1 << 20
+BLOCK_SIZE = 64 << 10
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+# Byte translation tables for randint_chunks().
+HIGH_BYTES = bytes(range(128, 256))
+SHIFT_LEFT = bytes((b << 1) & 0xff for b in range(256))
+TOP_BIT = bytes(b >> 7 for b in range(256))
+HIGH_BIT = bytes(b & 0x80 for b in range(256))
+
+
+def parse_size(size):
+    """
+    Parse a size such as '512M' or '2G' (powers of 1024) into bytes.
+    """
+    size = size.strip().upper()
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def _or_bytes(a, b):
+    return (int.from_bytes(a, 'little') | int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
+
+
+def randint_chunks(seed, chunk_size=CHUNK_SIZE):
+    """
+    Yield the byte stream of random.seed(seed) followed by repeated
+    randint(0, 255) calls, in chunks of up to 'chunk_size' bytes.
+
+    randint(0, 255) takes the top 9 bits of one 32-bit Mersenne Twister
+    output and draws again if they are 256 or more, i.e. if the top bit is
+    set. Here the outputs are drawn many at a time with getrandbits() and
+    the rejection and shifting are done with byte translations, so no
+    Python code runs per byte.
+    """
+    rng = random.Random(seed)
+    # About half of the outputs are rejected.
+    words = 2 * chunk_size
+    while True:
+        raw = rng.getrandbits(32 * words).to_bytes(4 * words, 'little')
+        # Bits 31..24 and 23..16 of each output.
+        b3 = raw[3::4]
+        b2 = raw[2::4]
+        # Accepted outputs are the ones with bit 31 clear. Their value is
+        # bits 30..24 shifted left by one plus bit 23; every rejected output
+        # is marked by a set high bit in both streams, then deleted.
+        high = b3.translate(None, HIGH_BYTES).translate(SHIFT_LEFT)
+        low = _or_bytes(b2.translate(TOP_BIT), b3.translate(HIGH_BIT)).translate(None, HIGH_BYTES)
+        yield _or_bytes(high, low)
+
+
+def shake_chunks(seed, chunk_size=CHUNK_SIZE, start=0):
+    """
+    Yield chunks of a counter-mode SHAKE-256 stream: chunk i is the first
+    'chunk_size' bytes of SHAKE-256('<seed>:<i>'). Much faster than
+    randint_chunks() and any chunk can be generated on its own.
+    """
+    index = start
+    while True:
+        yield shake_block(seed, index, chunk_size)
+        index += 1
+
+
+def shake_block(seed, index, size=CHUNK_SIZE):
+    return hashlib.shake_256(('%s:%d' % (seed, index)).encode()).digest(size)
+
+
+ALGORITHMS = {
+    'randint': randint_chunks,
+    'shake': shake_chunks,
+}
+
+
+def file_chunks(path, chunk_size=CHUNK_SIZE):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def take(chunks, size, block_size):
+    """
+    Yield the first 'size' bytes of the iterable 'chunks' in blocks of
+    'block_size' bytes (the last one may be shorter).
+    """
+    pending = b''
+    remaining = size
+    for chunk in chunks:
+        pending = pending + chunk if pending else chunk
+        start = 0
+        while len(pending) - start >= block_size and remaining > 0:
+            n = min(block_size, remaining)
+            yield pending[start:start + n]
+            start += n
+            remaining -= n
+        pending = pending[start:]
+        if remaining <= 0:
+            return
+    if pending and remaining > 0:
+        yield pending[:remaining]
+
+
+class Mutation(object):
+    """
+    Derives version N+1 of a payload from version N: a share of the blocks
+    get new content, new regions are inserted (shifting what follows) and a
+    tail is appended. All new content is derived from 'seed', so the same
+    options always give the same output.
+    """
+
+    def __init__(self, seed, base_size, block_size=BLOCK_SIZE, change_percent=0.0, inserts=(), append=0):
+        if not 0 <= change_percent <= 100:
+            raise ValueError('change_percent must be between 0 and 100, not %g' % change_percent)
+        self.seed = seed
+        self.base_size = base_size
+        self.block_size = block_size
+        self.inserts = sorted(inserts)
+        self.append = append
+        blocks = (base_size + block_size - 1) // block_size
+        count = int(round(blocks * change_percent / 100.0))
+        self.changed = set(random.Random('%s:changed' % seed).sample(range(blocks), count))
+        self.stats = {'changed_blocks': 0, 'changed_bytes': 0, 'inserted_bytes': 0, 'appended_bytes': 0}
+
+    def _new(self, kind, index, size):
+        return shake_block('%s:%s' % (self.seed, kind), index, size)
+
+    def _inserted(self, index):
+        offset, length = self.inserts[index]
+        self.stats['inserted_bytes'] += length
+        for start in range(0, length, CHUNK_SIZE):
+            yield self._new('insert-%d' % index, start // CHUNK_SIZE, min(CHUNK_SIZE, length - start))
+
+    def apply(self, base_blocks):
+        """
+        Yield the mutated payload, given the base as blocks of 'block_size'
+        bytes.
+        """
+        offset = 0
+        next_insert = 0
+        for index, block in enumerate(base_blocks):
+            if index in self.changed:
+                block = self._new('change', index, len(block))
+                self.stats['changed_blocks'] += 1
+                self.stats['changed_bytes'] += len(block)
+            end = offset + len(block)
+            while next_insert < len(self.inserts) and self.inserts[next_insert][0] < end:
+                at = max(0, self.inserts[next_insert][0] - offset)
+                yield block[:at]
+                block = block[at:]
+                offset += at
+                yield from self._inserted(next_insert)
+                next_insert += 1
+            yield block
+            offset = end
+        # Inserts at or beyond the end of the base.
+        while next_insert < len(self.inserts):
+            yield from self._inserted(next_insert)
+            next_insert += 1
+        for start in range(0, self.append, CHUNK_SIZE):
+            n = min(CHUNK_SIZE, self.append - start)
+            self.stats['appended_bytes'] += n
+            yield self._new('append', start // CHUNK_SIZE, n)
+
+    def manifest(self):
+        """
+        Expected outcome: the bytes not present in the base are the least
+        that any delta from the base to the output has to carry.
+        """
+        manifest = {'base_size': self.base_size, 'block_size': self.block_size}
+        manifest.update(self.stats)
+        manifest['expected_delta_bytes'] = (self.stats['changed_bytes'] + self.stats['inserted_bytes'] +
+                                            self.stats['appended_bytes'])
+        return manifest
+
+
+def write_stream(out, chunks, size=None):
+    """
+    Write the iterable 'chunks', or its first 'size' bytes, to 'out'.
+    Returns the number of bytes written and their SHA-256.
+    """
+    h = hashlib.sha256()
+    written = 0
+    for chunk in chunks:
+        if size is not None and written + len(chunk) > size:
+            chunk = chunk[:size - written]
+        out.write(chunk)
+        h.update(chunk)
+        written += len(chunk)
+        if size is not None and written >= size:
+            break
+    return written, h.hexdigest()
+
+
+def parse_insert(value):
+    offset, length = value.split(':')
+    return parse_size(offset), parse_size(length)
+
 
 def main():
-    n = int(sys.argv[2])
-    ba = bytearray(n)
+    parser = argparse.ArgumentParser(description='Write a file of seeded random content, or a controlled '
+                                                 'mutation of one to test update deltas')
+    parser.add_argument('output', help='file to write')
+    parser.add_argument('size', help='size in bytes, or with a K, M, G or T suffix; for a mutation, the size '
+                                     'of the generated base (default: all of --base)', nargs='?')
+    parser.add_argument('--seed', default='42', help='random seed (default: 42)')
+    parser.add_argument('--algorithm', choices=sorted(ALGORITHMS), default='randint',
+                        help='randint (default) reproduces random.randint(0, 255) byte by byte, '
+                             'shake is several times faster for large files')
+    group = parser.add_argument_group('mutation', 'Write a mutation of a base payload, which is either read '
+                                                  'from --base or generated from the options above')
+    group.add_argument('--base', help='existing payload to mutate')
+    group.add_argument('--change-percent', type=float, default=0.0, help='percentage of blocks to replace')
+    group.add_argument('--block-size', default=str(BLOCK_SIZE), help='size of the blocks (default: 64K)')
+    group.add_argument('--insert', type=parse_insert, action='append', default=[], metavar='OFFSET:LENGTH',
+                       help='insert LENGTH new bytes at OFFSET of the base, shifting the rest; repeatable')
+    group.add_argument('--append', default='0', help='number of new bytes to append')
+    group.add_argument('--mutation-seed', default=None, help='seed for the new content (default: <seed>+1)')
+    group.add_argument('--manifest', help='write the expected delta size and checksums to this JSON file')
+    args = parser.parse_args()
+
+    seed = int(args.seed) if args.seed.isdigit() else args.seed
+    append = parse_size(args.append)
+    mutate = args.base or args.change_percent or args.insert or append
+    if args.size is None and not args.base:
+        parser.error('a size is needed unless mutating --base')
+    if not 0 <= args.change_percent <= 100:
+        parser.error('--change-percent must be between 0 and 100, not %g' % args.change_percent)
+
+    if args.base:
+        base = file_chunks(args.base)
+        size = parse_size(args.size) if args.size else None
+        if size is None:
+            with open(args.base, 'rb') as f:
+                size = f.seek(0, 2)
+    else:
+        base = ALGORITHMS[args.algorithm](seed)
+        size = parse_size(args.size)
+
+    with open(args.output, 'wb') as f:
+        if not mutate:
+            written, digest = write_stream(f, base, size)
+            mutation = None
+        else:
+            mutation_seed = args.mutation_seed or '%s+1' % args.seed
+            mutation = Mutation(mutation_seed, size, parse_size(args.block_size), args.change_percent,
+                                args.insert, append)
+            written, digest = write_stream(f, mutation.apply(take(base, size, mutation.block_size)))
 
-    seed(42)
-    for i in range(0, n):
-       ba[i] = randint(0, 255)
+    if args.manifest:
+        manifest = mutation.manifest() if mutation else {'base_size': 0, 'expected_delta_bytes': written}
+        manifest.update({'size': written, 'sha256': digest, 'seed': args.seed, 'algorithm': args.algorithm})
+        if args.base:
+            manifest['base'] = args.base
+        with open(args.manifest, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+            f.write('\n')
 
-    with open(sys.argv[1], 'wb') as f:
-        f.write(bytes(ba))
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
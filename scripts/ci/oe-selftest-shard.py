@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# Run meta-updater's oe-selftest classes on several workers at once.
+#
+# Every test class mutates local.conf and bblayers.conf, so each worker gets
+# a build directory of its own, configured by configure.sh with the same
+# TEST_BITBAKE_COMMON_DIR so that sstate and downloads are shared. Classes
+# are handed out longest first (LPT), using the durations recorded by
+# previous runs, so the whole set takes about as long as the slowest class.
+
+import argparse
+import json
+import os
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+from os.path import abspath, dirname, exists, join
+from time import monotonic
+
+SCRIPT_DIR = abspath(dirname(__file__))
+CASES_PATH = join('lib', 'oeqa', 'selftest', 'cases')
+DEFAULT_MODULES = ['updater_qemux86_64', 'updater_qemux86_64_ptest', 'updater_minnowboard', 'updater_raspberrypi']
+# Assumed duration of a class that has never been run.
+DEFAULT_DURATION = 1800
+
+
+def find_script(name):
+    # In the CI image the scripts are copied next to each other in /scripts.
+    for d in [SCRIPT_DIR, '/scripts']:
+        if exists(join(d, name)):
+            return join(d, name)
+    raise FileNotFoundError(name)
+
+
+def cases_dir():
+    # Run from a checkout, or from /scripts in the CI image.
+    for d in [join(dirname(dirname(SCRIPT_DIR)), CASES_PATH),
+              join(os.environ.get('TEST_REPO_DIR', 'updater-repo'), 'meta-updater', CASES_PATH)]:
+        if exists(d):
+            return d
+    raise FileNotFoundError(CASES_PATH)
+
+
+def test_classes(modules):
+    """
+    Return 'module.Class' for every top-level OESelftestTestCase subclass
+    defined in 'modules'. The modules are scanned rather than imported, as
+    they need bitbake's environment.
+    """
+    classes = []
+    for module in modules:
+        names = ['OESelftestTestCase']
+        with open(join(cases_dir(), module + '.py')) as f:
+            for name, base in re.findall(r'^class (\w+)\((\w+)\):', f.read(), re.MULTILINE):
+                if base in names:
+                    names.append(name)
+                    classes.append('%s.%s' % (module, name))
+    return classes
+
+
+def load_durations(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_durations(path, durations):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(durations, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def lpt_order(classes, durations):
+    """
+    Sort 'classes' longest expected duration first. Classes without history
+    are assumed to take as long as the median of the known ones.
+    """
+    known = [durations[c] for c in classes if c in durations]
+    default = statistics.median(known) if known else DEFAULT_DURATION
+    return sorted(classes, key=lambda c: durations.get(c, default), reverse=True)
+
+
+class Worker(object):
+    def __init__(self, index, build_dir, env):
+        self.index = index
+        self.build_dir = build_dir
+        self.env = dict(env)
+        self.env['TEST_BUILD_DIR'] = build_dir
+        # Own QEMU port range (WORKER_PORT_STRIDE ports per worker) and MAC
+        # prefix, see find_local_port() in qemucommand.py.
+        self.env['QEMU_WORKER_ID'] = str(index)
+        self.child = None
+
+    def _run(self, cmdline, log_path):
+        with open(log_path, 'a') as log:
+            self.child = subprocess.Popen(cmdline, env=self.env, stdout=log, stderr=subprocess.STDOUT,
+                                          stdin=subprocess.DEVNULL, start_new_session=True)
+            retcode = self.child.wait()
+            self.child = None
+        return retcode
+
+    def configure(self):
+        os.makedirs(self.build_dir, exist_ok=True)
+        return self._run([find_script('configure.sh')], join(self.build_dir, 'configure.log'))
+
+    def run_class(self, test_class):
+        log_path = join(self.build_dir, 'oe-selftest-%s.log' % test_class)
+        return self._run([find_script('oe-selftest.sh'), test_class], log_path)
+
+    def interrupt(self):
+        if self.child:
+            os.killpg(self.child.pid, signal.SIGINT)
+
+
+class ShardRunner(object):
+    def __init__(self, classes, workers, durations):
+        self.queue = lpt_order(classes, durations)
+        self.workers = workers
+        self.durations = durations
+        self.results = {}
+        self.stopping = False
+        self._lock = threading.Lock()
+
+    def _next(self):
+        with self._lock:
+            if self.stopping or not self.queue:
+                return None
+            return self.queue.pop(0)
+
+    def _work(self, worker):
+        if worker.configure() != 0:
+            print('[worker %d] configure.sh failed, see %s/configure.log' % (worker.index, worker.build_dir))
+            return
+        while True:
+            test_class = self._next()
+            if test_class is None:
+                return
+            print('[worker %d] %s' % (worker.index, test_class))
+            started = monotonic()
+            retcode = worker.run_class(test_class)
+            elapsed = monotonic() - started
+            with self._lock:
+                self.results[test_class] = (worker.index, retcode, elapsed)
+                if retcode == 0:
+                    # Only complete runs are representative.
+                    self.durations[test_class] = round(elapsed)
+            print('[worker %d] %s %s in %ds' % (worker.index, test_class, 'passed' if retcode == 0 else 'FAILED',
+                                                 elapsed))
+
+    def run(self):
+        threads = [threading.Thread(target=self._work, args=(w,)) for w in self.workers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def handle_signal(self, signo, stack_frame):
+        print('Interrupted, stopping workers')
+        with self._lock:
+            self.stopping = True
+        for w in self.workers:
+            w.interrupt()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run oe-selftest classes in parallel build directories')
+    parser.add_argument('-j', '--workers', type=int, default=max(1, (os.cpu_count() or 1) // 8),
+                        help='Number of parallel workers (default: one per 8 CPUs)')
+    parser.add_argument('--modules', nargs='+', default=DEFAULT_MODULES,
+                        help='Selftest modules to take test classes from')
+    parser.add_argument('--durations', default=None,
+                        help='JSON file with the duration of each class from previous runs '
+                             '(default: TEST_BITBAKE_COMMON_DIR/oe-selftest-durations.json)')
+    parser.add_argument('classes', nargs='*', help='Test classes to run (default: all in --modules)')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    build_dir = env.get('TEST_BUILD_DIR', 'build')
+    common_dir = abspath(env.get('TEST_BITBAKE_COMMON_DIR') or 'bitbake-common')
+    env['TEST_BITBAKE_COMMON_DIR'] = common_dir
+    os.makedirs(common_dir, exist_ok=True)
+    durations_path = args.durations or join(common_dir, 'oe-selftest-durations.json')
+
+    classes = args.classes or test_classes(args.modules)
+    durations = load_durations(durations_path)
+    workers = [Worker(i, '%s-shard%d' % (build_dir, i), env) for i in range(min(args.workers, len(classes)))]
+    runner = ShardRunner(classes, workers, durations)
+    print('Running %d classes on %d workers: %s' % (len(classes), len(workers), ', '.join(runner.queue)))
+    signal.signal(signal.SIGINT, runner.handle_signal)
+    runner.run()
+    save_durations(durations_path, durations)
+
+    failed = 0
+    for test_class in classes:
+        if test_class not in runner.results:
+            print('%-60s %s' % (test_class, 'not run'))
+            failed += 1
+            continue
+        index, retcode, elapsed = runner.results[test_class]
+        print('%-60s %-6s worker %d %6ds' % (test_class, 'pass' if retcode == 0 else 'FAIL', index, elapsed))
+        failed += retcode != 0
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
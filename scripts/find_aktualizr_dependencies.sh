@@ -8,16 +8,19 @@ parentdir="$(dirname "$0")"
 # testing (tuf-test-vectors, jsoncpp, and HdrHistogram_c), or any other third
 # party modules included directly into the source tree. Also check libp11 and
 # systemd since those are common dependencies not enabled by default.
-${parentdir}/find_dependencies.py aktualizr
-${parentdir}/find_dependencies.py aktualizr-shared-prov
-${parentdir}/find_dependencies.py aktualizr-shared-prov-creds
-${parentdir}/find_dependencies.py aktualizr-device-prov
-${parentdir}/find_dependencies.py aktualizr-device-prov-hsm
-${parentdir}/find_dependencies.py aktualizr-auto-reboot
-${parentdir}/find_dependencies.py aktualizr-disable-send-ip
-${parentdir}/find_dependencies.py aktualizr-log-debug
-${parentdir}/find_dependencies.py aktualizr-polling-interval
-${parentdir}/find_dependencies.py aktualizr-virtualsec
-${parentdir}/find_dependencies.py libp11
-${parentdir}/find_dependencies.py systemd
-
+#
+# All recipes go through one invocation so that the dependencies they share
+# are only parsed once. One <recipe>-dependencies.yml is written per recipe.
+${parentdir}/find_dependencies.py \
+    aktualizr \
+    aktualizr-shared-prov \
+    aktualizr-shared-prov-creds \
+    aktualizr-device-prov \
+    aktualizr-device-prov-hsm \
+    aktualizr-auto-reboot \
+    aktualizr-disable-send-ip \
+    aktualizr-log-debug \
+    aktualizr-polling-interval \
+    aktualizr-virtualsec \
+    libp11 \
+    systemd
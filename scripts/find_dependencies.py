@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
+import hashlib
+import json
 import os.path
+import sqlite3
+import subprocess
 import sys
 
 scripts_path = os.path.dirname(os.path.realpath(__file__))
@@ -11,6 +15,8 @@ sys.path = sys.path + [bb_lib_path]
 import bb.fetch2
 import bb.tinfoil
 
+from manifestwriter import FORMATS
+
 
 PRINT_PROGRESS = True
 SKIP_BUILD_TOOLS = True
@@ -37,134 +43,383 @@ KNOWN_BUILD_TOOLS = ['virtual/x86_64-poky-linux-gcc', # gcc-cross-x86_64
 
 
 def get_recipe_info(tinfoil, rn):
+    """
+    Return the cached recipe information for 'rn', which is enough to know
+    its name, version and DEPENDS without parsing it.
+    """
     try:
         info = tinfoil.get_recipe_info(rn)
     except Exception:
         print('Failed to get recipe info for: %s' % rn)
-        return []
+        return None
     if not info:
         print('No recipe info found for: %s' % rn)
-        return []
-    append_files = tinfoil.get_file_appends(info.fn)
+        return None
+    return info
+
+
+def parse_recipe(tinfoil, info, append_files):
     appends = True
-    data = tinfoil.parse_recipe_file(info.fn, appends, append_files)
-    data.pn = info.pn
-    data.pv = info.pv
-    return data
+    return tinfoil.parse_recipe_file(info.fn, appends, append_files)
 
 
-def print_package(manifest_file, data, is_project):
-    src_uri = data.getVar('SRC_URI').split()
-    lic = data.getVar('LICENSE')
-    summary = data.getVar('SUMMARY')
-    homepage = data.getVar('HOMEPAGE')
-    srcrev = data.getVar('SRCREV')
-    branch = data.getVar('BRANCH')
+# Variables that go into the manifest.
+RECORD_VARS = ['SRC_URI', 'LICENSE', 'SUMMARY', 'DESCRIPTION', 'HOMEPAGE', 'SRCREV', 'BRANCH']
 
+
+def recipe_record(info, data):
+    """
+    Return what the manifest needs from a parsed recipe as a plain dict.
+    """
+    record = {'pn': info.pn, 'pv': info.pv, 'local_paths': {}}
+    for var in RECORD_VARS:
+        record[var] = data.getVar(var)
+    local = []
+    for src in (record['SRC_URI'] or '').split():
+        src = src.split(';', maxsplit=1)[0]
+        if src.startswith('file://') and src not in local:
+            local.append(src)
+    if local:
+        # TODO: Get full path of patches and other files within the source
+        # repo, not just the filesystem?
+        # Setting up a fetcher expands the datastore, so use one for all of
+        # the recipe's files.
+        fetch = bb.fetch2.Fetch(local, data)
+        for src in local:
+            record['local_paths'][src] = fetch.localpath(src)
+    return record
+
+
+def layer_revisions(config_data):
+    """
+    Return the git revision of each configured layer, or the modification
+    time of its layer.conf when it is not in git.
+    """
+    revisions = []
+    for layer in config_data.getVar('BBLAYERS').split():
+        try:
+            rev = subprocess.check_output(['git', '-C', layer, 'rev-parse', 'HEAD'],
+                                          stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            try:
+                rev = str(os.stat(os.path.join(layer, 'conf', 'layer.conf')).st_mtime_ns)
+            except OSError:
+                rev = ''
+        revisions.append((layer, rev))
+    return revisions
+
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+class FileHashes(object):
+    """
+    SHA-256 of local files, remembered per (path, size, mtime). With a
+    RecipeCache database the hashes are kept between runs as well.
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+        self.memo = {}
+        if db:
+            db.execute('CREATE TABLE IF NOT EXISTS file_hashes '
+                       '(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, sha256 TEXT)')
+
+    def get(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return ''
+        if not os.path.isfile(path):
+            # E.g. a directory of files.
+            return ''
+        key = (path, st.st_size, st.st_mtime_ns)
+        if key in self.memo:
+            return self.memo[key]
+        digest = None
+        if self.db:
+            row = self.db.execute('SELECT sha256 FROM file_hashes WHERE path = ? AND size = ? AND mtime = ?',
+                                  key).fetchone()
+            digest = row[0] if row else None
+        if digest is None:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            if self.db:
+                self.db.execute('INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)', key + (digest,))
+        self.memo[key] = digest
+        return digest
+
+
+class RecipeCache(object):
+    """
+    Manifest records of previously parsed recipes, kept in SQLite between
+    runs. A record is only used if the configuration files (local.conf,
+    site.conf, auto.conf, ...) and layer revisions are the same and none of
+    the files the recipe was parsed from (the recipe, its bbappends and
+    every class, .inc or other file it inherited, required or included)
+    changed.
+    """
+
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path, config_data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS recipes')
+            self.db.execute('PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+        self.db.execute('CREATE TABLE IF NOT EXISTS recipes '
+                        '(fn TEXT PRIMARY KEY, key TEXT, depends TEXT, record TEXT)')
+        h = hashlib.sha256()
+        for layer, rev in layer_revisions(config_data):
+            h.update(('%s %s\n' % (layer, rev)).encode())
+        for var in ['MACHINE', 'DISTRO', 'TUNE_PKGARCH']:
+            h.update(('%s=%s\n' % (var, config_data.getVar(var))).encode())
+        for f in (config_data.getVar('BBINCLUDED') or '').split():
+            h.update(('%s %d\n' % (f, file_mtime(f))).encode())
+        self.config_key = h.hexdigest()
+
+    def key(self, info, append_files):
+        # The full list of files is only known after parsing, see get().
+        h = hashlib.sha256(self.config_key.encode())
+        for f in [info.fn] + list(append_files):
+            h.update(('%s %d\n' % (f, file_mtime(f))).encode())
+        return h.hexdigest()
+
+    def get(self, fn, key):
+        row = self.db.execute('SELECT depends, record FROM recipes WHERE fn = ? AND key = ?', (fn, key)).fetchone()
+        if not row:
+            return None
+        for f, mtime in json.loads(row[0]):
+            if file_mtime(f) != mtime:
+                return None
+        return json.loads(row[1])
+
+    def put(self, fn, key, record, data):
+        """
+        Store 'record', with the files the recipe in 'data' was parsed from.
+        """
+        depends = [(f, file_mtime(f)) for f, _ in data.getVar('__depends', False) or []]
+        self.db.execute('INSERT OR REPLACE INTO recipes VALUES (?, ?, ?, ?)',
+                        (fn, key, json.dumps(depends), json.dumps(record)))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def package_entry(record, dependencies, is_project, file_hashes=None):
+    """
+    Return the manifest entry of the recipe in 'record' as a dict, in the
+    order its fields are written. 'dependencies' are package ids. With
+    'file_hashes' (a FileHashes), the hashes of local files are included.
+    """
+    entry = {
+        'id': {
+            'package_manager': 'Yocto',
+            'namespace': '',
+            'name': record['pn'],
+            'version': record['pv'],
+        },
+        'declared_lics': [record['LICENSE'] or ''],
+    }
     if is_project:
-        manifest_file.write('  id:\n')
-    else:
-        manifest_file.write('- id:\n')
-    manifest_file.write('    package_manager: "Yocto"\n')
-    manifest_file.write('    namespace: ""\n')
-    manifest_file.write('    name: "%s"\n' % data.pn)
-    manifest_file.write('    version: "%s"\n' % data.pv)
-    manifest_file.write('  declared_lics:\n')
-    manifest_file.write('  - "%s"\n' % lic)
-    if is_project:
-        manifest_file.write('  aliases: []\n')
-    if summary:
-        manifest_file.write('  description: "%s"\n' % summary)
-    else:
-        description = data.getVar('DESCRIPTION')
-        manifest_file.write('  description: "%s"\n' % description)
-    manifest_file.write('  homepage_url: "%s"\n' % homepage)
+        entry['aliases'] = []
+    entry['description'] = record['SUMMARY'] or record['DESCRIPTION'] or ''
+    entry['homepage_url'] = record['HOMEPAGE'] or ''
     # Binary artifacts almost never exist in Yocto.
-    manifest_file.write('  binary_artifact:\n')
-    manifest_file.write('    url: ""\n')
-    manifest_file.write('    hash: ""\n')
-    manifest_file.write('    hash_algorithm: ""\n')
-    manifest_file.write('  source_artifact:\n')
+    entry['binary_artifact'] = {'url': '', 'hash': '', 'hash_algorithm': ''}
+    sources = []
     repos = []
-    for src in src_uri:
+    for src in (record['SRC_URI'] or '').split():
         # Strip options.
         # TODO: ignore files with apply=false?
         src = src.split(';', maxsplit=1)[0]
         src_type = src.split('://', maxsplit=1)[0]
         if src_type == 'file':
-            # TODO: Get full path of patches and other files within the source
-            # repo, not just the filesystem?
-            fetch = bb.fetch2.Fetch([], data)
-            local = fetch.localpath(src)
-            manifest_file.write('  - "%s"\n' % local)
+            sources.append(record['local_paths'][src])
         else:
-            manifest_file.write('  - "%s"\n' % src)
+            sources.append(src)
             if src_type != 'http' and src_type != 'https' and src_type != 'ftp' and src_type != 'ssh':
                 repos.append(src)
+    entry['source_artifact'] = sources
+    if file_hashes is not None:
+        entry['local_files'] = [{'path': path, 'hash': file_hashes.get(path), 'hash_algorithm': 'SHA-256'}
+                                for path in record['local_paths'].values()]
     if len(repos) > 1:
-        print('Multiple repos for one package are not supported. Package: %s' % info.pn)
-    for repo in repos:
-        vcs_type, url = repo.split('://', maxsplit=1)
-        manifest_file.write('  vcs:\n')
+        # TODO: Actually support multiple repos here.
+        print('Multiple repos for one package are not supported. Package: %s' % record['pn'])
+    if repos:
+        vcs_type, url = repos[0].split('://', maxsplit=1)
         if vcs_type == 'gitsm':
             vcs_type = 'git'
-        manifest_file.write('    type: "%s"\n' % vcs_type)
-        manifest_file.write('    url: "%s"\n' % url)
-        # TODO: Actually support multiple repos here:
         # TODO: catch and replace AUTOINC?
-        manifest_file.write('    revision: "%s"\n' % srcrev)
-        manifest_file.write('    branch: "%s"\n' % branch)
-
-
-def find_dependencies(manifest_file, tinfoil, assume_provided, recipe_info, packages, rn, order):
-    data = recipe_info[rn]
-    # Filter out packages from the assume_provided list.
-    depends = []
-    for dep in data.depends:
-        if dep not in assume_provided:
-            depends.append(dep)
-
-    if PRINT_PROGRESS:
-        # Print high-order dependencies as a form of logging/progress notifcation.
-        if order == 2:
-            print(rn)
-        if order == 3:
-            print('  ' + rn)
-
-    # order == 1 is for the initial recipe. We've already printed its
-    # information, so skip it.
-    if order > 1:
-        spaces = '  ' * order
-        manifest_file.write('%s- namespace: ""\n' % spaces)
-        manifest_file.write('%s  name: "%s"\n' % (spaces, data.pn))
-        manifest_file.write('%s  version: "%s"\n' % (spaces, data.pv))
-        if not depends:
-            manifest_file.write('%s  dependencies: []\n' % spaces)
-        else:
-            manifest_file.write('%s  dependencies:\n' % spaces)
+        entry['vcs'] = {
+            'type': vcs_type,
+            'url': url,
+            'revision': record['SRCREV'] or '',
+            'branch': record['BRANCH'] or '',
+        }
+    if is_project:
+        entry['scopes'] = [{'name': 'all', 'delivered': True, 'dependencies': dependencies}]
+    else:
+        entry['dependencies'] = dependencies
+    return entry
+
+
+def package_id(record):
+    return 'Yocto::%s:%s' % (record['pn'], record['pv'])
+
+
+class DependencyGraph(object):
+    """
+    Dependency DAG below one or more recipes. Every recipe is looked up once
+    and its dependency list is kept once, however many recipes depend on it.
+
+    The graph is discovered breadth first from the DEPENDS recorded in
+    bitbake's recipe cache. Each recipe is then fully parsed for the
+    metadata that the cache does not hold, unless 'cache' (a RecipeCache)
+    has it from a previous run. Parsing is done one recipe at a time, as
+    the bitbake server behind tinfoil handles one request at a time.
+    """
+
+    def __init__(self, tinfoil, assume_provided, cache=None):
+        self.tinfoil = tinfoil
+        self.cache = cache
+        self.assume_provided = set(assume_provided)
+        # Recipe name -> cached recipe information, in the order they were
+        # found.
+        self.recipes = {}
+        # Recipe name -> manifest record.
+        self.data = {}
+        # Recipe name -> names of the recipes it depends on.
+        self.depends = {}
+        # DEPENDS entry (which may be a virtual/ provider) -> recipe name.
+        self.names = {}
+        self.parsed = 0
+        self.cached = 0
 
-    # First find all dependencies not seen yet to our master list.
-    for dep in depends:
-        if dep not in packages:
-            packages.append(dep)
-            dep_data = get_recipe_info(tinfoil, dep)
-            # Do this once now to reduce the number of bitbake calls.
-            dep_data.depends = dep_data.getVar('DEPENDS').split()
-            recipe_info[dep] = dep_data
+    def _resolve(self, dep):
+        if dep not in self.names:
+            info = get_recipe_info(self.tinfoil, dep)
+            if info is None:
+                self.names[dep] = None
+            else:
+                self.names[dep] = info.pn
+                self.recipes.setdefault(info.pn, info)
+        return self.names[dep]
+
+    def _parse(self, rn):
+        if rn in self.data:
+            return
+        info = self.recipes[rn]
+        append_files = self.tinfoil.get_file_appends(info.fn)
+        if self.cache:
+            key = self.cache.key(info, append_files)
+            record = self.cache.get(info.fn, key)
+            if record:
+                self.data[rn] = record
+                self.cached += 1
+                return
+        data = parse_recipe(self.tinfoil, info, append_files)
+        self.data[rn] = recipe_record(info, data)
+        self.parsed += 1
+        if self.cache:
+            self.cache.put(info.fn, key, self.data[rn], data)
+
+    def walk(self, info):
+        """
+        Add 'info' and everything it depends on, one level at a time. Parts
+        of the graph walked before are not walked again.
+        """
+        self.names[info.pn] = info.pn
+        self.recipes.setdefault(info.pn, info)
+        if info.pn in self.depends:
+            return
+        level = [info.pn]
+        queued = set(self.depends)
+        queued.add(info.pn)
+        order = 1
+        while level:
+            next_level = []
+            for rn in level:
+                depends = []
+                for dep in self.recipes[rn].depends:
+                    if dep in self.assume_provided:
+                        continue
+                    name = self._resolve(dep)
+                    if name is None or name in depends:
+                        continue
+                    depends.append(name)
+                    if name not in queued:
+                        queued.add(name)
+                        # Print high-order dependencies as a form of
+                        # logging/progress notification.
+                        if PRINT_PROGRESS and order <= 2:
+                            print('  ' * (order - 1) + name)
+                        next_level.append(name)
+                self.depends[rn] = depends
+                self._parse(rn)
+            level = next_level
+            order += 1
+
+    def closure(self, rn):
+        """
+        Return 'rn' and every recipe it depends on, breadth first.
+        """
+        result = [rn]
+        seen = {rn}
+        for current in result:
+            for dep in self.depends[current]:
+                if dep not in seen:
+                    seen.add(dep)
+                    result.append(dep)
+        return result
 
-    # Then recursively analyze all of the dependencies for the current recipe.
-    for dep in depends:
-        find_dependencies(manifest_file, tinfoil, assume_provided, recipe_info, packages, dep, order + 1)
+    def stats(self):
+        return '%d recipes: DEPENDS of %d read from the recipe cache, %d taken from the manifest cache, ' \
+            '%d fully parsed' % (len(self.recipes), len(self.depends), self.cached, self.parsed)
 
-    if order > 1:
-        manifest_file.write('%s  errors: []\n' % spaces)
+
+def write_manifest(graph, name, output_format='yaml', file_hashes=None):
+    """
+    Write the manifest of recipe 'name'. Packages are generated one at a
+    time and streamed out, listing the ids of their direct dependencies so
+    that shared sub-trees are written only once.
+    """
+    writer_class, extension = FORMATS[output_format]
+    rn = graph.names[name]
+    with open('%s-dependencies.%s' % (name, extension), 'w', buffering=1 << 16) as manifest_file:
+        writer = writer_class(manifest_file)
+        for p in graph.closure(rn):
+            refs = [package_id(graph.data[dep]) for dep in graph.depends[p]]
+            entry = package_entry(graph.data[p], refs, is_project=(p == rn), file_hashes=file_hashes)
+            if p == rn:
+                writer.project(entry)
+            else:
+                writer.package(entry)
+        writer.close()
 
 
 def main():
-    parser = ArgumentParser(description='Find all dependencies of a recipe.')
-    parser.add_argument('recipe', metavar='recipe', help='a recipe to investigate')
+    parser = ArgumentParser(description='Find all dependencies of one or more recipes.')
+    parser.add_argument('recipes', metavar='recipe', nargs='+',
+                        help='a recipe to investigate; one <recipe>-dependencies.<format> is written for each')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='yaml', help='manifest format (default: yaml)')
+    parser.add_argument('--cache-file', default=None,
+                        help='where to keep recipe metadata between runs '
+                             '(default: PERSISTENT_DIR/dependency-manifests.sqlite)')
+    parser.add_argument('--no-cache', action='store_true', help='parse every recipe again')
+    parser.add_argument('--hash-local-files', action='store_true',
+                        help='record the SHA-256 of the local files (file://) of each recipe')
     args = parser.parse_args()
-    rn = args.recipe
     with bb.tinfoil.Tinfoil() as tinfoil:
         tinfoil.prepare()
         # These are the packages that bitbake assumes are provided by the host
@@ -175,39 +430,35 @@ def main():
         if SKIP_BUILD_TOOLS:
             assume_provided.extend(KNOWN_BUILD_TOOLS)
 
-        data = get_recipe_info(tinfoil, rn)
-        if not data:
-            print('Nothing to do!')
-            return
-
-        with open(rn + '-dependencies.yml', "w") as manifest_file:
-            manifest_file.write('project:\n')
-            data.depends = []
-            depends = data.getVar('DEPENDS').split()
-            for dep in depends:
-                if dep not in assume_provided:
-                    data.depends.append(dep)
-            print_package(manifest_file, data, is_project=True)
-            manifest_file.write('  scopes:\n')
-            manifest_file.write('  - name: "all"\n')
-            manifest_file.write('    delivered: true\n')
-            if not data.depends:
-                manifest_file.write('    dependencies: []\n')
-            else:
-                manifest_file.write('    dependencies:\n')
-
-            recipe_info = dict([(rn, data)])
-            packages = []
-            find_dependencies(manifest_file, tinfoil, assume_provided, recipe_info, packages, rn, order=1)
+        cache = None
+        if not args.no_cache:
+            cache_file = args.cache_file or os.path.join(tinfoil.config_data.getVar('PERSISTENT_DIR'),
+                                                         'dependency-manifests.sqlite')
+            cache = RecipeCache(cache_file, tinfoil.config_data)
 
-            manifest_file.write('packages:\n')
+        # One graph for all recipes, so that what they have in common is
+        # looked up and parsed once.
+        graph = DependencyGraph(tinfoil, assume_provided, cache)
+        for rn in args.recipes:
+            info = get_recipe_info(tinfoil, rn)
+            if not info:
+                print('Nothing to do for %s!' % rn)
+                continue
+            print(rn + ':')
+            graph.walk(info)
+            # Manifests are named after the recipe as given on the command
+            # line, which need not be its PN.
+            graph.names[rn] = info.pn
+        print(graph.stats())
 
-            # Iterate through the list of packages found to print out their full
-            # information. Skip the initial recipe since we already printed it out.
-            for p in packages:
-                if p is not rn:
-                    data = recipe_info[p]
-                    print_package(manifest_file, data, is_project=False)
+        file_hashes = None
+        if args.hash_local_files:
+            file_hashes = FileHashes(cache.db if cache else None)
+        for rn in args.recipes:
+            if graph.names.get(rn):
+                write_manifest(graph, rn, args.format, file_hashes)
+        if cache:
+            cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+import json
+
+
+def _yaml_scalar(value):
+    if value is None:
+        return '""'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return '[]'
+    if isinstance(value, dict):
+        return '{}'
+    # A JSON string is a valid double-quoted YAML scalar with every special
+    # character escaped.
+    return json.dumps(str(value))
+
+
+def write_yaml(out, value, indent='', first_indent=None):
+    """
+    Write dict 'value' as block-style YAML indented by 'indent'. The first
+    line is indented by 'first_indent' instead if given, e.g. to start a
+    list item.
+    """
+    for key, item in value.items():
+        prefix = indent if first_indent is None else first_indent
+        first_indent = None
+        if isinstance(item, dict) and item:
+            out.write('%s%s:\n' % (prefix, key))
+            write_yaml(out, item, indent + '  ')
+        elif isinstance(item, (list, tuple)) and item:
+            out.write('%s%s:\n' % (prefix, key))
+            write_yaml_list(out, item, indent)
+        else:
+            out.write('%s%s: %s\n' % (prefix, key, _yaml_scalar(item)))
+
+
+def write_yaml_list(out, items, indent=''):
+    for item in items:
+        if isinstance(item, dict) and item:
+            write_yaml(out, item, indent + '  ', first_indent=indent + '- ')
+        else:
+            out.write('%s- %s\n' % (indent, _yaml_scalar(item)))
+
+
+class ManifestWriter(object):
+    """
+    Streams a manifest to 'out': one project, then any number of packages,
+    each written as soon as it is passed in.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.packages = 0
+
+    def project(self, entry):
+        raise NotImplementedError
+
+    def package(self, entry):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class YamlManifestWriter(ManifestWriter):
+    def project(self, entry):
+        self.out.write('project:\n')
+        write_yaml(self.out, entry, '  ')
+
+    def package(self, entry):
+        if not self.packages:
+            self.out.write('packages:\n')
+        self.packages += 1
+        write_yaml_list(self.out, [entry])
+
+    def close(self):
+        if not self.packages:
+            self.out.write('packages: []\n')
+
+
+class JsonManifestWriter(ManifestWriter):
+    def project(self, entry):
+        self.out.write('{"project": %s,\n "packages": [' % json.dumps(entry))
+
+    def package(self, entry):
+        self.out.write('%s\n  %s' % (',' if self.packages else '', json.dumps(entry)))
+        self.packages += 1
+
+    def close(self):
+        self.out.write(']}\n')
+
+
+class JsonLinesManifestWriter(ManifestWriter):
+    """
+    One JSON object per line: the project first, then the packages.
+    """
+
+    def project(self, entry):
+        self.out.write(json.dumps({'project': entry}) + '\n')
+
+    def package(self, entry):
+        self.out.write(json.dumps({'package': entry}) + '\n')
+        self.packages += 1
+
+
+# Output format -> writer class and file extension.
+FORMATS = {
+    'yaml': (YamlManifestWriter, 'yml'),
+    'json': (JsonManifestWriter, 'json'),
+    'jsonl': (JsonLinesManifestWriter, 'jsonl'),
+}
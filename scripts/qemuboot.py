@@ -0,0 +1,155 @@
+import asyncio
+import errno
+import re
+import select
+import socket
+import threading
+from time import monotonic, sleep
+
+from qemuconsole import SerialConsole
+
+# Serial console markers for each boot phase, in the order they are expected
+# to show up. The 'sshd' phase is not taken from the console; it is marked
+# when the forwarded SSH port answers with a protocol banner.
+BOOT_PHASES = [
+    ('firmware', re.compile(r'U-Boot|BdsDxe|UEFI')),
+    ('kernel', re.compile(r'Linux version|Starting kernel')),
+    ('initrd', re.compile(r'Starting OSTree initrd script|Run /init as init process')),
+    ('userspace', re.compile(r'Switching to rootfs|systemd\[1\]|INIT: version')),
+]
+
+
+class BootTimeline(object):
+    """
+    Time (in seconds since launch) at which each boot phase was first seen.
+    """
+
+    PHASES = [name for name, _ in BOOT_PHASES] + ['sshd', 'shutdown']
+
+    def __init__(self, started=None):
+        self.started = monotonic() if started is None else started
+        self.marks = {}
+        self.ready = False
+        self._lock = threading.Lock()
+
+    def mark(self, phase, at=None):
+        with self._lock:
+            if phase not in self.marks:
+                self.marks[phase] = monotonic() - self.started if at is None else at
+
+    def durations(self):
+        """
+        Return (phase, seconds) pairs for the phases seen so far, where each
+        phase lasts until the next one that was seen.
+        """
+        seen = [(p, self.marks[p]) for p in self.PHASES if p in self.marks]
+        result = []
+        previous = 0.0
+        for phase, at in seen:
+            result.append((phase, at - previous))
+            previous = at
+        return result
+
+    def __str__(self):
+        phases = ', '.join('%s %.1fs' % (p, d) for p, d in self.durations())
+        return '%s (%s)' % ('ready' if self.ready else 'not ready', phases or 'no phases seen')
+
+
+class PhaseListener(object):
+    """
+    Console listener that marks boot phases on a BootTimeline as their
+    markers appear. 'offset' converts the console's times, which count from
+    when the console was started, to the timeline's.
+    """
+
+    def __init__(self, timeline, offset=0.0):
+        self.timeline = timeline
+        self.offset = offset
+        self._pending = list(BOOT_PHASES)
+
+    def __call__(self, line, t):
+        # Phases without a console marker (e.g. no initrd) are skipped.
+        for i, (phase, marker) in enumerate(self._pending):
+            if marker.search(line):
+                self.timeline.mark(phase, t + self.offset)
+                del self._pending[:i + 1]
+                break
+
+
+def probe_ssh(port, timeout=1.0, host='127.0.0.1'):
+    """
+    Return the SSH banner offered on 'port', or None if nothing answers.
+
+    QEMU user networking accepts forwarded connections before the guest is up,
+    so a successful connect alone does not mean sshd is running.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setblocking(False)
+    try:
+        err = s.connect_ex((host, port))
+        if err not in (0, errno.EINPROGRESS):
+            return None
+        _, writable, _ = select.select([], [s], [], timeout)
+        if not writable or s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+            return None
+        readable, _, _ = select.select([s], [], [], timeout)
+        if not readable:
+            return None
+        banner = s.recv(256)
+    except OSError:
+        return None
+    finally:
+        s.close()
+    if not banner.startswith(b'SSH-'):
+        return None
+    return banner.splitlines()[0]
+
+
+def wait_until_ready(qemu, process=None, timeout=300, started=None, console=None, monitor=None,
+                     poll_interval=0.5):
+    """
+    Block until the guest started from 'qemu' answers on its SSH port, the
+    QEMU 'process' exits or 'timeout' seconds have passed. Boot phases are
+    taken from 'console', a SerialConsole; without one a temporary console
+    reader is used. Only console lines read from 'started' (a monotonic()
+    time, default now) on count; pass the time of the launch, reset or
+    reboot. With a QmpMonitor as 'monitor', a guest shutdown (its SHUTDOWN
+    event) ends the wait right away rather than at the next SSH probe.
+
+    Returns a BootTimeline; check its 'ready' attribute for the outcome.
+    """
+    timeline = BootTimeline(started)
+    own_console = console is None
+    if own_console:
+        console = SerialConsole(qemu.serial_port, started=timeline.started)
+    listener = PhaseListener(timeline, console.started - timeline.started)
+    # Lines may have been read before we got here, but a reused console also
+    # holds those of earlier boots.
+    console.add_listener(listener, since=timeline.started)
+    deadline = monotonic() + timeout
+    try:
+        while monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                break
+            if probe_ssh(qemu.ssh_port, timeout=min(poll_interval * 4, 2.0)):
+                timeline.mark('sshd')
+                timeline.ready = True
+                break
+            if monitor is None:
+                sleep(poll_interval)
+                continue
+            try:
+                event = monitor.wait_for_event('SHUTDOWN', poll_interval)
+            except asyncio.TimeoutError:
+                continue
+            if event is None:
+                # The monitor connection is gone, keep probing.
+                monitor = None
+                continue
+            timeline.mark('shutdown')
+            break
+    finally:
+        console.remove_listener(listener)
+        if own_console:
+            console.close()
+    return timeline
@@ -1,9 +1,16 @@
-from os.path import exists, isdir, join, realpath, abspath
-from os import listdir
+from os.path import basename, exists, isdir, join, realpath, abspath
+from os import listdir, makedirs
+from glob import glob
+import fcntl
+import hashlib
+import json
+import os
 import random
+import shutil
 import socket
-from shutil import copyfile
-from subprocess import check_output
+from tempfile import gettempdir, mkdtemp
+from qemuimage import IMAGE_CACHE_DIR, IMAGE_CACHE_SIZE, ImageCache, clone_image, file_digest, qcow2_backing_file
+from qemuqmp import QmpMonitor
 
 EXTENSIONS = {
     'intel-corei7-64': 'wic',
@@ -11,31 +18,148 @@ EXTENSIONS = {
 }
 
 
+# Ports handed out by find_local_port() are locked through a file in this
+# directory for as long as the allocating process lives, so that concurrent
+# launches on the same host do not pick the same port in the window between
+# probing it and QEMU binding it.
+PORT_LOCK_DIR = join(gettempdir(), 'qemucommand-ports')
+
+# Parallel test workers (see scripts/ci/oe-selftest-shard.py) set
+# QEMU_WORKER_ID so that each searches its own port range and hands out MAC
+# addresses with its own prefix. A worker only scans the WORKER_PORT_STRIDE
+# ports of its own range, so the ranges of different workers never overlap.
+WORKER_ID = int(os.environ.get('QEMU_WORKER_ID', '0'))
+WORKER_PORT_STRIDE = 100
+
+_reserved_ports = {}
+_used_macs = set()
+
+
+def _try_lock(path):
+    """
+    Take an exclusive lock on 'path' without waiting. Returns the open lock
+    file, which holds the lock until it is closed, or None if another
+    process holds it.
+    """
+    lock = open(path, 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+def _lock_port(port):
+    makedirs(PORT_LOCK_DIR, exist_ok=True)
+    return _try_lock(join(PORT_LOCK_DIR, '%d.lock' % port))
+
+
 def find_local_port(start_port):
     """"
-    Find the next free TCP port after 'start_port'.
+    Find and reserve the next free TCP port after 'start_port' within the
+    WORKER_PORT_STRIDE ports of this worker's range.
     """
 
-    for port in range(start_port, start_port + 10):
+    start_port += WORKER_ID * WORKER_PORT_STRIDE
+    for port in range(start_port, start_port + WORKER_PORT_STRIDE):
+        if port in _reserved_ports:
+            continue
+        lock = _lock_port(port)
+        if lock is None:
+            print("Skipping port %d (reserved by another launcher)" % port)
+            continue
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.bind(('', port))
-            return port
         except socket.error:
             print("Skipping port %d" % port)
+            lock.close()
+            continue
         finally:
             s.close()
-    raise Exception("Could not find a free TCP port")
+        _reserved_ports[port] = lock
+        return port
+    raise Exception("Could not find a free TCP port in %d-%d" % (start_port, start_port + WORKER_PORT_STRIDE - 1))
+
+
+def release_port(port):
+    lock = _reserved_ports.pop(port, None)
+    if lock:
+        lock.close()
 
 
 def random_mac():
-    """Return a random Ethernet MAC address
+    """Return a random Ethernet MAC address, unique within this process
     @link https://www.iana.org/assignments/ethernet-numbers/ethernet-numbers.xhtml#ethernet-numbers-2
     """
-    head = "ca:fe:"
+    head = "ca:fe:%02x:" % (WORKER_ID % 256)
     hex_digits = '0123456789abcdef'
-    tail = ':'.join([random.choice(hex_digits) + random.choice(hex_digits) for _ in range(4)])
-    return head + tail
+    while True:
+        tail = ':'.join([random.choice(hex_digits) + random.choice(hex_digits) for _ in range(3)])
+        if tail not in _used_macs:
+            _used_macs.add(tail)
+            return head + tail
+
+
+# ioctl(KVM_GET_API_VERSION), _IO(KVMIO, 0x00). Every usable KVM reports 12.
+KVM_GET_API_VERSION = 0xAE00
+KVM_API_VERSION = 12
+KVM_CACHE_FILE = join(os.path.dirname(IMAGE_CACHE_DIR), 'kvm.json')
+
+# Overlays holding a post-boot 'savevm' snapshot, named
+# <options hash>-<image hash>.cow so that a rebuilt image gets a new one.
+# A guest writes to its checkpoint overlay, so parallel workers keep theirs
+# apart, and a guest using one holds <overlay>.lock so that other runs on
+# the same host neither share nor delete it.
+CHECKPOINT_DIR = join(os.path.dirname(IMAGE_CACHE_DIR),
+                      'checkpoints-%d' % WORKER_ID if WORKER_ID else 'checkpoints')
+CHECKPOINT_TAG = 'booted'
+
+_kvm_available = None
+
+
+def _probe_kvm():
+    try:
+        fd = os.open('/dev/kvm', os.O_RDWR | os.O_CLOEXEC)
+    except OSError:
+        return False
+    try:
+        return fcntl.ioctl(fd, KVM_GET_API_VERSION) == KVM_API_VERSION
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def kvm_available():
+    """
+    Return whether KVM can be used, probing /dev/kvm once per process. The
+    result is also kept on disk per kernel release and reused as long as
+    access to /dev/kvm has not changed.
+    """
+    global _kvm_available
+    if _kvm_available is not None:
+        return _kvm_available
+
+    key = '%s:%s' % (os.uname().release, os.access('/dev/kvm', os.R_OK | os.W_OK))
+    try:
+        with open(KVM_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if key in cache:
+        _kvm_available = cache[key]
+        return _kvm_available
+
+    _kvm_available = _probe_kvm()
+    try:
+        makedirs(os.path.dirname(KVM_CACHE_FILE), exist_ok=True)
+        with open(KVM_CACHE_FILE, 'w') as f:
+            json.dump({key: _kvm_available}, f)
+    except OSError:
+        pass
+    return _kvm_available
 
 
 class QemuCommand(object):
@@ -70,7 +194,40 @@ class QemuCommand(object):
             else:
                 raise ValueError("Could not autodetect machine type. More than one entry in %s. Maybe --machine qemux86-64?" % args.dir)
 
-        # If using an overlay with U-Boot, copy the rom when we create the
+        self.image_cache = ImageCache(getattr(args, 'image_cache_dir', None) or IMAGE_CACHE_DIR,
+                                      getattr(args, 'image_cache_size', None) or IMAGE_CACHE_SIZE)
+
+        if exists(args.imagename):
+            image = realpath(args.imagename)
+        else:
+            ext = EXTENSIONS.get(self.machine, 'wic')
+            image = join(args.dir, self.machine, '%s-%s.%s' % (args.imagename, self.machine, ext))
+
+        if args.kvm is None:
+            self.kvm = kvm_available()
+        else:
+            self.kvm = args.kvm
+        self.accelerator = 'KVM' if self.kvm else 'TCG'
+        if args.mem:
+            self.mem = args.mem
+        else:
+            self.mem = "1G"
+
+        # A checkpoint is a 'savevm' snapshot taken right after boot in an
+        # overlay managed here. Once it exists, the guest is started from it
+        # with -loadvm instead of booting.
+        self.checkpoint = getattr(args, 'checkpoint', False)
+        self.loadvm = None
+        self._checkpoint_lock = None
+        self._private_dir = None
+        self.qmp_socket = getattr(args, 'qmp', None)
+        self._monitor = None
+        if self.checkpoint:
+            if not self.enable_u_boot or args.efi or self.overlay:
+                raise EnvironmentError("Checkpoints are only supported with U-Boot and without --overlay!")
+            self._setup_checkpoint(args, image)
+
+        # If using an overlay with U-Boot, clone the rom when we create the
         # overlay so that we can keep it around just in case.
         if args.efi:
             self.bios = 'OVMF.fd'
@@ -85,10 +242,7 @@ class QemuCommand(object):
                     if not exists(uboot_path):
                         raise ValueError("U-Boot image %s does not exist" % uboot_path)
                     if not exists(new_uboot_path):
-                        if self.dry_run:
-                            print("cp %s %s" % (uboot_path, new_uboot_path))
-                        else:
-                            copyfile(uboot_path, new_uboot_path)
+                        self._clone(uboot_path, new_uboot_path)
                 uboot_path = new_uboot_path
             if not exists(uboot_path) and not (self.dry_run and not exists(self.overlay)):
                 raise ValueError("U-Boot image %s does not exist" % uboot_path)
@@ -98,24 +252,27 @@ class QemuCommand(object):
 
         # If using an overlay, we need to keep the "backing" image around, as
         # bitbake will often clean it up, and the overlay silently depends on
-        # the hardcoded path. The easiest solution is to keep the file and use
-        # a relative path to it.
-        if exists(args.imagename):
-            image = realpath(args.imagename)
-        else:
-            ext = EXTENSIONS.get(self.machine, 'wic')
-            image = join(args.dir, self.machine, '%s-%s.%s' % (args.imagename, self.machine, ext))
+        # the hardcoded path. New overlays are backed by an entry in the shared
+        # image cache, so overlays of the same build share one copy. Overlays
+        # created before the cache existed keep using their <overlay>.img.
         if self.overlay:
-            new_image_path = self.overlay + '.img'
-            if not exists(self.overlay):
+            legacy_image_path = self.overlay + '.img'
+            if exists(self.overlay):
+                if exists(legacy_image_path):
+                    self.image = legacy_image_path
+                else:
+                    self.image = qcow2_backing_file(self.overlay)
+                    if not self.image:
+                        raise ValueError("Overlay %s has no backing image" % self.overlay)
+                    self.image_cache.touch(self.image)
+            else:
                 if not exists(image):
                     raise ValueError("OS image %s does not exist" % image)
-                if not exists(new_image_path):
-                    if self.dry_run:
-                        print("cp %s %s" % (image, new_image_path))
-                    else:
-                        copyfile(image, new_image_path)
-            self.image = new_image_path
+                if self.dry_run:
+                    print("cache %s in %s" % (image, self.image_cache.cache_dir))
+                    self.image = realpath(image)
+                else:
+                    self.image = self.image_cache.acquire(image, self.overlay)
         else:
             self.image = realpath(image)
         if not exists(self.image) and not (self.dry_run and not exists(self.overlay)):
@@ -123,23 +280,10 @@ class QemuCommand(object):
 
         if args.mac:
             self.mac_address = args.mac
-        else:
+        elif not self.checkpoint:
             self.mac_address = random_mac()
         self.serial_port = find_local_port(8990)
         self.ssh_port = find_local_port(2222)
-        if args.mem:
-            self.mem = args.mem
-        else:
-            self.mem = "1G"
-        if args.kvm is None:
-            # Autodetect KVM using 'kvm-ok'
-            try:
-                check_output(['kvm-ok'])
-                self.kvm = True
-            except Exception:
-                self.kvm = False
-        else:
-            self.kvm = args.kvm
         self.gui = not args.no_gui
         self.gdb = args.gdb
         self.pcap = args.pcap
@@ -149,6 +293,80 @@ class QemuCommand(object):
         if hasattr(args, 'host_forward'):
             self.host_fwd = args.host_forward
 
+    def _setup_checkpoint(self, args, image):
+        if not exists(image):
+            raise ValueError("OS image %s does not exist" % image)
+        uboot_path = args.bootloader or abspath(join(args.dir, self.machine, 'u-boot-qemux86-64.rom'))
+        options = json.dumps([self.machine, self.mem, self.kvm, args.secondary_network, args.mac,
+                              file_digest(uboot_path, self.image_cache.cache_dir)])
+        options_key = hashlib.sha256(options.encode()).hexdigest()[:16]
+        image_key = file_digest(image, self.image_cache.cache_dir)[:16]
+        makedirs(CHECKPOINT_DIR, exist_ok=True)
+        self.overlay = join(CHECKPOINT_DIR, '%s-%s.cow' % (options_key, image_key))
+        self._checkpoint_lock = None if self.dry_run else _try_lock(self.overlay + '.lock')
+        if self._checkpoint_lock is None and not self.dry_run:
+            # Another run on this host is using the checkpoint. Boot on an
+            # overlay of our own, which lives only as long as this guest.
+            self._private_dir = mkdtemp(prefix='qemu-checkpoint-')
+            self.overlay = join(self._private_dir, basename(self.overlay))
+            print("Checkpoint %s is in use, booting on private overlay %s" %
+                  (join(CHECKPOINT_DIR, basename(self.overlay)), self.overlay))
+        else:
+            # Drop checkpoints of previous builds made with the same options,
+            # unless a guest is still running from them.
+            for stale in glob(join(CHECKPOINT_DIR, options_key + '-*.cow')):
+                if stale == self.overlay:
+                    continue
+                lock = _try_lock(stale + '.lock')
+                if lock is None:
+                    continue
+                with lock:
+                    for path in glob(stale + '*'):
+                        os.unlink(path)
+        if exists(self.overlay + '.ready'):
+            self.loadvm = CHECKPOINT_TAG
+        elif exists(self.overlay):
+            # Left over from a run that never got to take the snapshot; its
+            # disk may already have been modified.
+            for leftover in glob(self.overlay + '*'):
+                os.unlink(leftover)
+        # The guest's network configuration is part of the snapshot, so the
+        # MAC address has to stay the same from one run to the next.
+        self.mac_address = 'ca:fe:' + ':'.join(options_key[i:i + 2] for i in range(0, 8, 2))
+        if not self.qmp_socket:
+            self.qmp_socket = join(gettempdir(), 'qemu-qmp-%d-%s.sock' % (os.getpid(), options_key))
+
+    def monitor(self):
+        """
+        Return the QMP monitor of the running guest, connecting on first use.
+        Only one client can be connected to the socket at a time.
+        """
+        if not self.qmp_socket:
+            raise EnvironmentError("QEMU was not started with a QMP socket")
+        if self._monitor is None:
+            self._monitor = QmpMonitor(self.qmp_socket)
+        return self._monitor
+
+    def close_monitor(self):
+        if self._monitor:
+            self._monitor.close()
+            self._monitor = None
+
+    def save_checkpoint(self):
+        self.monitor().hmp('savevm %s' % CHECKPOINT_TAG)
+        open(self.overlay + '.ready', 'w').close()
+        self.loadvm = CHECKPOINT_TAG
+
+    def restore_checkpoint(self):
+        self.monitor().hmp('loadvm %s' % CHECKPOINT_TAG)
+
+    def _clone(self, src, dst):
+        if self.dry_run:
+            print("cp %s %s" % (src, dst))
+            return
+        strategy, written = clone_image(src, dst)
+        print("Created %s from %s using %s (%d bytes written)" % (dst, src, strategy, written))
+
     def command_line(self):
         netuser = 'user,hostfwd=tcp:0.0.0.0:%d-:22,restrict=off' % self.ssh_port
         if self.gdb:
@@ -199,16 +417,36 @@ class QemuCommand(object):
             cmdline += ['-cpu', 'Haswell']
         if self.overlay:
             cmdline.append(self.overlay)
+        if self.qmp_socket:
+            cmdline += ["-qmp", "unix:%s,server,nowait" % self.qmp_socket]
+        if self.loadvm:
+            cmdline += ["-loadvm", self.loadvm]
 
         # If booting with u-boot is disabled, add kernel command line arguments through qemu -append option
         if not self.enable_u_boot:
             cmdline += ["-append", "root=/dev/vda rw highres=off console=ttyS0 ip=dhcp"]
         return cmdline
 
+    def release_ports(self):
+        release_port(self.serial_port)
+        release_port(self.ssh_port)
+
+    def release_checkpoint(self):
+        """
+        Give up the checkpoint overlay once QEMU has exited: unlock it, or
+        delete it if it was a private one.
+        """
+        if self._checkpoint_lock:
+            self._checkpoint_lock.close()
+            self._checkpoint_lock = None
+        if self._private_dir:
+            shutil.rmtree(self._private_dir, ignore_errors=True)
+            self._private_dir = None
+
     def img_command_line(self):
         cmdline = [
             "qemu-img", "create",
-            "-o", "backing_file=%s" % self.image,
+            "-o", "backing_file=%s,backing_fmt=raw" % self.image,
             "-f", "qcow2",
             self.overlay]
         return cmdline
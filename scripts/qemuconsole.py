@@ -0,0 +1,183 @@
+import asyncio
+import gzip
+import os
+import re
+import shutil
+import threading
+from collections import deque
+from time import monotonic, strftime
+
+# Console lines worth finding again, indexed as they stream past.
+CONSOLE_MARKERS = {
+    'u-boot': re.compile(r'U-Boot \d'),
+    'kernel': re.compile(r'Linux version'),
+    'ostree-prepare-root': re.compile(r'ostree-prepare-root'),
+    'switch-root': re.compile(r'Switching to rootfs'),
+    'aktualizr': re.compile(r'Started Aktualizr|Aktualizr version'),
+}
+
+
+class ConsoleTimeout(Exception):
+    pass
+
+
+class RotatingCompressedLog(object):
+    """
+    Append-only text log. When it grows beyond 'max_bytes' it is gzipped to
+    <path>.1.gz (shifting older ones up to <path>.<backups>.gz) and restarted.
+    """
+
+    def __init__(self, path, max_bytes=16 << 20, backups=5):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'a')
+
+    def write(self, text):
+        self._file.write(text)
+        self._file.flush()
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        for n in range(self.backups - 1, 0, -1):
+            older = '%s.%d.gz' % (self.path, n)
+            if os.path.exists(older):
+                os.replace(older, '%s.%d.gz' % (self.path, n + 1))
+        with open(self.path, 'rb') as src, gzip.open(self.path + '.1.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        self._file = open(self.path, 'w')
+
+    def close(self):
+        self._file.close()
+
+
+class SerialConsole(object):
+    """
+    Streams the serial console QEMU serves on a TCP port. Each line is
+    timestamped, appended to an optional rotating log, kept in a bounded
+    in-memory buffer and checked against CONSOLE_MARKERS.
+
+    QEMU accepts a single client on the port, so everything that needs the
+    console (see add_listener) should share one instance.
+    """
+
+    def __init__(self, port, log_path=None, host='127.0.0.1', started=None, keep_lines=2000):
+        self.port = port
+        self.host = host
+        self.started = monotonic() if started is None else started
+        self.log = RotatingCompressedLog(log_path) if log_path else None
+        self.lines = deque(maxlen=keep_lines)
+        self.index = {}
+        self.line_count = 0
+        self._listeners = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._reader_task = None
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+
+    async def _start(self):
+        self._reader_task = asyncio.ensure_future(self._read())
+
+    async def _stop(self):
+        self._reader_task.cancel()
+        await asyncio.gather(self._reader_task, return_exceptions=True)
+
+    async def _read(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=1 << 20)
+                break
+            except OSError:
+                await asyncio.sleep(0.1)
+        try:
+            while True:
+                try:
+                    raw = await reader.readline()
+                except ValueError:
+                    # Overlong line, take what is there.
+                    raw = await reader.read(1 << 20)
+                if not raw:
+                    break
+                self._add_line(raw.decode(errors='replace').rstrip('\r\n'))
+        finally:
+            writer.close()
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+
+    def _add_line(self, line):
+        t = monotonic() - self.started
+        with self._cond:
+            self.line_count += 1
+            self.lines.append((self.line_count, t, line))
+            for name, marker in CONSOLE_MARKERS.items():
+                if marker.search(line):
+                    self.index.setdefault(name, []).append((self.line_count, t))
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        if self.log:
+            self.log.write('%s %9.3f %s\n' % (strftime('%H:%M:%S'), t, line))
+        for listener in listeners:
+            listener(line, t)
+
+    def add_listener(self, callback, since=None):
+        """
+        Call 'callback(line, seconds_since_start)' for every new line. If
+        'since' (a monotonic() time) is given, first call it for the lines
+        still buffered that were read from then on.
+        """
+        with self._cond:
+            if since is not None:
+                for _, t, line in self.lines:
+                    if self.started + t >= since:
+                        callback(line, t)
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._cond:
+            self._listeners.remove(callback)
+
+    def excerpt(self, count=50):
+        with self._cond:
+            return '\n'.join(line for _, _, line in list(self.lines)[-count:])
+
+    def wait_for(self, marker, timeout, since=0):
+        """
+        Block until a line after line number 'since' matches 'marker', which
+        is either a CONSOLE_MARKERS name or a regular expression. Returns the
+        matching line; raises ConsoleTimeout with the last lines of the
+        console if none shows up within 'timeout' seconds.
+        """
+        pattern = CONSOLE_MARKERS.get(marker) or re.compile(marker)
+        deadline = monotonic() + timeout
+        seen = since
+        with self._cond:
+            while True:
+                for number, _, line in self.lines:
+                    if number > seen:
+                        seen = number
+                        if pattern.search(line):
+                            return line
+                remaining = deadline - monotonic()
+                if remaining <= 0 or self._closed:
+                    break
+                self._cond.wait(remaining)
+        raise ConsoleTimeout("'%s' did not appear on the console within %ds. Last lines:\n%s" %
+                             (marker, timeout, self.excerpt()))
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._stop(), self._loop).result(5)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        if self.log:
+            self.log.close()
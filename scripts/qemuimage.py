@@ -0,0 +1,271 @@
+from os.path import exists, expanduser, join
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import struct
+import time
+
+# Linux ioctl to share all extents of one file with another (btrfs, XFS, ...).
+FICLONE = 0x40049409
+
+COPY_CHUNK = 1 << 20
+
+# copy_file_range() errors that mean it can not be used for this pair of
+# files, as opposed to a failure to read or write them.
+COPY_FILE_RANGE_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL)
+
+IMAGE_CACHE_DIR = os.environ.get('QEMU_IMAGE_CACHE_DIR',
+                                 join(os.environ.get('XDG_CACHE_HOME', expanduser('~/.cache')),
+                                      'meta-updater', 'qemu-images'))
+IMAGE_CACHE_SIZE = os.environ.get('QEMU_IMAGE_CACHE_SIZE', '20G')
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(size):
+    """
+    Parse a size such as '512M' or '20G' into bytes.
+    """
+    size = str(size).strip().upper()
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def qcow2_backing_file(path):
+    """
+    Return the backing file recorded in the header of qcow2 image 'path', or
+    None if there is none.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(20)
+        if len(header) < 20 or header[:4] != b'QFI\xfb':
+            return None
+        offset, size = struct.unpack('>QI', header[8:20])
+        if not offset:
+            return None
+        f.seek(offset)
+        return f.read(size).decode()
+
+
+def reflink(src, dst):
+    """
+    Clone 'src' to 'dst' sharing the underlying extents. Raises OSError if
+    the filesystem does not support it.
+    """
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            os.unlink(dst)
+            raise
+
+
+def sparse_copy(src, dst):
+    """
+    Copy only the data regions of 'src' to 'dst', leaving holes as holes.
+    Returns the number of bytes written.
+    """
+    written = 0
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        sfd, dfd = s.fileno(), d.fileno()
+        size = os.fstat(sfd).st_size
+        use_copy_file_range = hasattr(os, 'copy_file_range')
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(sfd, offset, os.SEEK_DATA)
+                end = os.lseek(sfd, start, os.SEEK_HOLE)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # No data after offset, the rest is a hole.
+                    break
+                if e.errno != errno.EINVAL:
+                    raise
+                # SEEK_DATA is not supported, treat everything as data.
+                start, end = offset, size
+            pos = start
+            while pos < end:
+                n = min(COPY_CHUNK, end - pos)
+                if use_copy_file_range:
+                    try:
+                        n = os.copy_file_range(sfd, dfd, n, pos, pos)
+                    except OSError as e:
+                        if e.errno not in COPY_FILE_RANGE_UNSUPPORTED:
+                            raise
+                        # E.g. between different file systems.
+                        use_copy_file_range = False
+                        continue
+                else:
+                    n = os.pwrite(dfd, os.pread(sfd, n, pos), pos)
+                if n == 0:
+                    break
+                pos += n
+            written += pos - start
+            offset = end
+        os.ftruncate(dfd, size)
+    return written
+
+
+def _cache_lock(cache_dir):
+    """
+    Take the lock that serializes changes to 'cache_dir'.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    lock = open(join(cache_dir, '.lock'), 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+
+def file_digest(path, cache_dir=IMAGE_CACHE_DIR):
+    """
+    Return the SHA-256 of 'path'. Digests are remembered per (path, inode,
+    size, mtime) so that an unchanged image is only read once.
+    """
+    st = os.stat(path)
+    key = '%s:%d:%d:%d' % (os.path.realpath(path), st.st_ino, st.st_size, st.st_mtime_ns)
+    memo_path = join(cache_dir, 'digests.json')
+    memo = _load_json(memo_path)
+    if key in memo:
+        return memo[key]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    # Re-read under the lock so that digests added by other processes in
+    # the meantime are kept.
+    with _cache_lock(cache_dir):
+        memo = _load_json(memo_path)
+        memo[key] = digest
+        tmp = memo_path + '.%d' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump(memo, f)
+        os.replace(tmp, memo_path)
+    return digest
+
+
+def _load_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _cache_entry(src, digest, cache_dir):
+    """
+    Return the content-addressed cache entry for 'src', whose SHA-256 is
+    'digest', and the number of bytes written to create it. The entry is a
+    copy: a hard link would let writes to 'src' change it. Must be called
+    with the cache locked.
+    """
+    entry = join(cache_dir, digest)
+    if exists(entry):
+        return entry, 0
+    tmp = entry + '.%d' % os.getpid()
+    written = 0
+    try:
+        reflink(src, tmp)
+    except OSError:
+        written = sparse_copy(src, tmp)
+    os.replace(tmp, entry)
+    return entry, written
+
+
+def clone_image(src, dst):
+    """
+    Make 'dst' a private copy of 'src' with as little I/O as possible: a
+    reflink where the filesystem supports it, a sparse-aware copy otherwise.
+    Returns the strategy used and the number of bytes written.
+    """
+    try:
+        reflink(src, dst)
+        return 'reflink', 0
+    except OSError:
+        pass
+    return 'sparse-copy', sparse_copy(src, dst)
+
+
+class ImageCache(object):
+    """
+    Machine-wide store of QEMU backing images, one file per distinct image
+    content named by its SHA-256.
+
+    Every overlay created on top of an entry is recorded as a reference.
+    When the cache grows beyond 'max_size' bytes, entries that no existing
+    overlay refers to are evicted, least recently used first.
+    """
+
+    def __init__(self, cache_dir=IMAGE_CACHE_DIR, max_size=IMAGE_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = parse_size(max_size)
+        self.index_path = join(cache_dir, 'index.json')
+
+    def _locked(self):
+        return _cache_lock(self.cache_dir)
+
+    def _load(self):
+        return _load_json(self.index_path)
+
+    def _save(self, index):
+        tmp = self.index_path + '.%d' % os.getpid()
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(tmp, self.index_path)
+
+    def acquire(self, image, overlay):
+        """
+        Return the cache entry holding the content of 'image', adding it if
+        needed, and record 'overlay' as a reference to it.
+        """
+        # Hashing takes the lock itself, and only briefly.
+        digest = file_digest(image, self.cache_dir)
+        with self._locked():
+            entry, written = _cache_entry(image, digest, self.cache_dir)
+            index = self._load()
+            record = index.setdefault(digest, {'refs': []})
+            record['size'] = os.stat(entry).st_blocks * 512
+            record['last_used'] = time.time()
+            overlay = os.path.abspath(overlay)
+            if overlay not in record['refs']:
+                record['refs'].append(overlay)
+            self._evict(index, keep=digest)
+            self._save(index)
+        print("Using cached image %s for %s (%d bytes written)" % (entry, image, written))
+        return entry
+
+    def touch(self, entry):
+        """
+        Mark 'entry' as used now, if it belongs to this cache.
+        """
+        digest = os.path.basename(entry or '')
+        with self._locked():
+            index = self._load()
+            if digest in index:
+                index[digest]['last_used'] = time.time()
+                self._save(index)
+
+    def refcount(self, digest, index=None):
+        if index is None:
+            index = self._load()
+        record = index.get(digest, {'refs': []})
+        record['refs'] = [r for r in record['refs'] if exists(r)]
+        return len(record['refs'])
+
+    def _evict(self, index, keep=None):
+        total = sum(r['size'] for r in index.values())
+        for digest in sorted(index, key=lambda d: index[d]['last_used']):
+            if total <= self.max_size:
+                break
+            if digest == keep or self.refcount(digest, index) > 0:
+                continue
+            try:
+                os.unlink(join(self.cache_dir, digest))
+            except FileNotFoundError:
+                pass
+            total -= index.pop(digest)['size']
+            print("Evicted unused cached image %s" % digest)
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import threading
+from time import time
+
+
+class QmpError(Exception):
+    pass
+
+
+class AsyncQmpClient(object):
+    """
+    Small asyncio client for the QEMU Machine Protocol on a unix socket.
+
+    Command replies are matched to their request by id, so commands may be
+    issued while other coroutines wait for events. Every event received is
+    kept in 'event_log' along with the time it arrived.
+    """
+
+    def __init__(self):
+        self.event_log = []
+        self._reader = None
+        self._writer = None
+        self._pending = {}
+        self._next_id = 0
+        self._events = None
+        self._read_task = None
+
+    async def connect(self, path, timeout=30):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(path)
+                break
+            except OSError:
+                if loop.time() > deadline:
+                    raise QmpError("Could not connect to QMP socket %s" % path)
+                await asyncio.sleep(0.1)
+        self._events = asyncio.Queue()
+        greeting = json.loads(await self._reader.readline())
+        if 'QMP' not in greeting:
+            raise QmpError("Unexpected QMP greeting: %s" % greeting)
+        self._read_task = asyncio.ensure_future(self._read_loop())
+        await self.execute('qmp_capabilities')
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line.decode())
+                if 'event' in msg:
+                    msg['received'] = time()
+                    self.event_log.append(msg)
+                    self._events.put_nowait(msg)
+                elif msg.get('id') in self._pending:
+                    self._pending.pop(msg['id']).set_result(msg)
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(QmpError("QMP connection closed"))
+            self._pending.clear()
+            # Wake up anybody waiting for an event.
+            self._events.put_nowait(None)
+
+    async def execute(self, command, **arguments):
+        if self._read_task is None or self._read_task.done():
+            raise QmpError("QMP connection closed")
+        self._next_id += 1
+        msg = {'execute': command, 'id': self._next_id}
+        if arguments:
+            msg['arguments'] = arguments
+        future = asyncio.get_running_loop().create_future()
+        self._pending[self._next_id] = future
+        self._writer.write(json.dumps(msg).encode() + b'\n')
+        await self._writer.drain()
+        reply = await future
+        if 'error' in reply:
+            raise QmpError("%s: %s" % (command, reply['error'].get('desc', reply['error'])))
+        return reply['return']
+
+    async def wait_for_event(self, names=None, timeout=None):
+        """
+        Return the next event whose name is in 'names' (any event if None),
+        or None if the connection closes first.
+        """
+        async def _wait():
+            while True:
+                event = await self._events.get()
+                if event is None:
+                    # Keep the marker for other waiters.
+                    self._events.put_nowait(None)
+                    return None
+                if names is None or event['event'] in names:
+                    return event
+        return await asyncio.wait_for(_wait(), timeout)
+
+    async def clear_events(self):
+        """
+        Forget events that have not been waited for yet.
+        """
+        while not self._events.empty():
+            if self._events.get_nowait() is None:
+                self._events.put_nowait(None)
+                break
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+        if self._read_task:
+            await asyncio.gather(self._read_task, return_exceptions=True)
+
+
+class QmpMonitor(object):
+    """
+    Synchronous front end to AsyncQmpClient, which runs on its own event loop
+    thread so that events are collected while the caller is busy elsewhere.
+    """
+
+    def __init__(self, path, timeout=30):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self.client = AsyncQmpClient()
+        try:
+            self._call(self.client.connect(path, timeout))
+        except Exception:
+            self._stop_loop()
+            raise
+
+    def _call(self, coro, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def _stop_loop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    @property
+    def event_log(self):
+        return self.client.event_log
+
+    def execute(self, command, **arguments):
+        return self._call(self.client.execute(command, **arguments))
+
+    def hmp(self, command_line):
+        """
+        Run a human monitor command, e.g. 'savevm' which has no QMP
+        equivalent in older QEMU versions.
+        """
+        output = self.execute('human-monitor-command', **{'command-line': command_line})
+        if 'Error' in output:
+            raise QmpError("%s: %s" % (command_line, output.strip()))
+        return output
+
+    def wait_for_event(self, names=None, timeout=None):
+        """
+        Block until one of the events in 'names' arrives. Raises
+        asyncio.TimeoutError if it does not within 'timeout' seconds, and
+        returns None if the connection closes first.
+        """
+        if isinstance(names, str):
+            names = [names]
+        return self._call(self.client.wait_for_event(names, timeout))
+
+    def clear_events(self):
+        self._call(self.client.clear_events())
+
+    def status(self):
+        return self.execute('query-status')['status']
+
+    def powerdown(self, timeout=60):
+        """
+        Ask the guest to shut down through ACPI and wait until it has.
+        Returns False if it did not within 'timeout' seconds.
+        """
+        self.clear_events()
+        self.execute('system_powerdown')
+        try:
+            return self.wait_for_event('SHUTDOWN', timeout) is not None
+        except asyncio.TimeoutError:
+            return False
+
+    def sample(self):
+        """
+        Return a snapshot of per-device block I/O counters and vCPU state.
+        """
+        return {
+            'time': time(),
+            'blockstats': self.execute('query-blockstats'),
+            'cpus': self.execute('query-cpus-fast'),
+        }
+
+    def close(self):
+        try:
+            self._call(self.client.close(), timeout=5)
+        finally:
+            self._stop_loop()
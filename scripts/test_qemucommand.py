@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+# Run with: python3 -m unittest discover -s scripts -p 'test_*.py'
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import qemucommand
+from qemucommand import QemuCommand
+
+
+def create_overlay(qemu):
+    """
+    Stand in for the overlay qemu-img creates: a qcow2 header naming the
+    backing image, which is all QemuCommand reads of it.
+    """
+    backing = qemu.image.encode()
+    with open(qemu.overlay, 'wb') as f:
+        f.write(b'QFI\xfb' + struct.pack('>IQI', 3, 72, len(backing)))
+        f.seek(72)
+        f.write(backing)
+
+
+class CheckpointTests(unittest.TestCase):
+    """
+    Two runs on one host that boot the same image with the same options
+    must not share or delete each other's checkpoint overlay.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='qemucommand-test-')
+        deploy = os.path.join(self.dir, 'deploy', 'qemux86-64')
+        os.makedirs(deploy)
+        self.image = os.path.join(deploy, 'core-image-minimal-qemux86-64.ota-ext4')
+        with open(self.image, 'wb') as f:
+            f.write(b'rootfs')
+        with open(os.path.join(deploy, 'u-boot-qemux86-64.rom'), 'wb') as f:
+            f.write(b'u-boot')
+        self.checkpoints = os.path.join(self.dir, 'checkpoints')
+        patcher = mock.patch.object(qemucommand, 'CHECKPOINT_DIR', self.checkpoints)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.commands = []
+
+    def tearDown(self):
+        for qemu in self.commands:
+            qemu.release_ports()
+            qemu.release_checkpoint()
+        shutil.rmtree(self.dir)
+
+    def launch(self, mem='128M'):
+        args = type('', (), {})()
+        args.imagename = 'core-image-minimal'
+        args.dir = os.path.join(self.dir, 'deploy')
+        args.machine = 'qemux86-64'
+        args.mac = None
+        args.efi = False
+        args.bootloader = None
+        args.mem = mem
+        args.kvm = False
+        args.no_gui = True
+        args.gdb = False
+        args.pcap = None
+        args.overlay = None
+        args.dry_run = False
+        args.secondary_network = False
+        args.uboot_enable = 'yes'
+        args.checkpoint = True
+        args.image_cache_dir = os.path.join(self.dir, 'cache')
+        qemu = QemuCommand(args)
+        self.commands.append(qemu)
+        return qemu
+
+    def test_second_run_gets_private_overlay(self):
+        first = self.launch()
+        create_overlay(first)
+        second = self.launch()
+        self.assertEqual(os.path.dirname(first.overlay), self.checkpoints)
+        self.assertNotEqual(os.path.dirname(second.overlay), self.checkpoints)
+        self.assertEqual(os.path.basename(second.overlay), os.path.basename(first.overlay))
+        # The shared overlay without a snapshot is only cleaned up by its owner.
+        self.assertTrue(os.path.exists(first.overlay))
+
+        private_dir = os.path.dirname(second.overlay)
+        second.release_checkpoint()
+        self.assertFalse(os.path.exists(private_dir))
+
+    def test_checkpoint_is_reused_once_released(self):
+        first = self.launch()
+        create_overlay(first)
+        open(first.overlay + '.ready', 'w').close()
+        first.release_checkpoint()
+        second = self.launch()
+        self.assertEqual(second.overlay, first.overlay)
+        self.assertEqual(second.loadvm, qemucommand.CHECKPOINT_TAG)
+
+    def test_stale_checkpoint_in_use_is_kept(self):
+        first = self.launch()
+        create_overlay(first)
+        # A rebuilt image gets a new checkpoint, and the old one is dropped
+        # unless a guest still runs from it.
+        with open(self.image, 'wb') as f:
+            f.write(b'rebuilt rootfs')
+        second = self.launch()
+        self.assertNotEqual(second.overlay, first.overlay)
+        self.assertTrue(os.path.exists(first.overlay))
+        first.release_checkpoint()
+        third_image = b'rebuilt again'
+        with open(self.image, 'wb') as f:
+            f.write(third_image)
+        second.release_checkpoint()
+        third = self.launch()
+        self.assertFalse(os.path.exists(first.overlay))
+        self.assertFalse(os.path.exists(second.overlay))
+        self.assertTrue(third.overlay.startswith(self.checkpoints))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Run with: python3 -m unittest discover -s scripts -p 'test_*.py'
+
+import gzip
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from time import monotonic
+
+from qemuconsole import ConsoleTimeout, RotatingCompressedLog, SerialConsole
+
+
+class FakeSerialPort(object):
+    """
+    TCP server standing in for QEMU's serial console: it accepts one client
+    and writes whatever is passed to send().
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+        self.conn = None
+        self._accepted = threading.Event()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        self.conn, _ = self.sock.accept()
+        self._accepted.set()
+
+    def send(self, data):
+        self._accepted.wait(5)
+        self.conn.sendall(data)
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+        self.sock.close()
+
+
+class RotatingCompressedLogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='console-test-')
+        self.path = os.path.join(self.dir, 'console.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_rotates_into_gzipped_backups(self):
+        log = RotatingCompressedLog(self.path, max_bytes=100, backups=2)
+        for i in range(4):
+            log.write('%d' % i * 100 + '\n')
+        log.write('tail\n')
+        log.close()
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'tail\n')
+        # Only the newest 'backups' logs are kept, newest first.
+        with gzip.open(self.path + '.1.gz', 'rt') as f:
+            self.assertEqual(f.read(), '3' * 100 + '\n')
+        with gzip.open(self.path + '.2.gz', 'rt') as f:
+            self.assertEqual(f.read(), '2' * 100 + '\n')
+        self.assertFalse(os.path.exists(self.path + '.3.gz'))
+
+
+class SerialConsoleTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='console-test-')
+        self.log_path = os.path.join(self.dir, 'console.log')
+        self.port = FakeSerialPort()
+        self.console = SerialConsole(self.port.port, log_path=self.log_path)
+
+    def tearDown(self):
+        self.console.close()
+        self.port.close()
+        shutil.rmtree(self.dir)
+
+    def test_wait_for_marker(self):
+        self.port.send(b'U-Boot 2021.07\r\nStarting kernel ...\r\n[    0.000000] Linux version 5.14\r\n')
+        line = self.console.wait_for('kernel', timeout=5)
+        self.assertIn('Linux version 5.14', line)
+        self.assertEqual([number for number, _ in self.console.index['u-boot']], [1])
+        self.assertEqual([number for number, _ in self.console.index['kernel']], [3])
+        # Lines up to 'since' are not looked at again.
+        self.port.send(b'login: \r\n')
+        self.assertEqual(self.console.wait_for(r'login:', timeout=5, since=3), 'login: ')
+        with self.assertRaises(ConsoleTimeout):
+            self.console.wait_for('kernel', timeout=0.2, since=3)
+
+    def test_timeout_shows_last_lines(self):
+        self.port.send(b'Booting from ROM\r\n')
+        self.console.wait_for('ROM', timeout=5)
+        with self.assertRaisesRegex(ConsoleTimeout, r"'aktualizr' did not appear(.|\n)*Booting from ROM"):
+            self.console.wait_for('aktualizr', timeout=0.2)
+        self.assertEqual(self.console.excerpt(1), 'Booting from ROM')
+
+    def test_lines_are_logged_with_times(self):
+        self.port.send(b'first\r\nsecond\r\nthird\r\n')
+        # A line is logged after waiters are woken, but before the next one is read.
+        self.console.wait_for('third', timeout=5)
+        with open(self.log_path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual([line.split(None, 2)[2] for line in lines[:2]], ['first', 'second'])
+        self.assertRegex(lines[0], r'^\d\d:\d\d:\d\d +\d+\.\d{3} first$')
+
+    def test_listener_replays_only_lines_since(self):
+        self.port.send(b'old boot\r\n')
+        self.console.wait_for('old boot', timeout=5)
+        since = monotonic()
+        seen = []
+        done = threading.Event()
+
+        def listener(line, t):
+            seen.append(line)
+            done.set()
+        self.console.add_listener(listener, since=since)
+        self.port.send(b'new boot\r\n')
+        self.assertTrue(done.wait(5))
+        self.assertEqual(seen, ['new boot'])
+
+
+if __name__ == '__main__':
+    unittest.main()
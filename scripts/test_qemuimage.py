@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Run with: python3 -m unittest discover -s scripts -p 'test_*.py'
+
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import qemuimage
+from qemuimage import ImageCache, clone_image, sparse_copy
+
+
+class SparseCopyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='image-test-')
+        self.src = os.path.join(self.dir, 'image.wic')
+        # Data, a hole, data and a trailing hole.
+        with open(self.src, 'wb') as f:
+            f.write(os.urandom(3 << 20))
+            f.seek(8 << 20)
+            f.write(os.urandom(1 << 20))
+            f.truncate(16 << 20)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertSameContent(self, a, b):
+        with open(a, 'rb') as fa, open(b, 'rb') as fb:
+            self.assertEqual(hashlib.sha256(fa.read()).digest(), hashlib.sha256(fb.read()).digest())
+
+    def test_copies_data_only(self):
+        dst = os.path.join(self.dir, 'copy')
+        written = sparse_copy(self.src, dst)
+        self.assertSameContent(self.src, dst)
+        self.assertLessEqual(written, os.path.getsize(self.src))
+
+    def test_falls_back_when_copy_file_range_fails(self):
+        for code in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+            dst = os.path.join(self.dir, 'copy-%d' % code)
+            with mock.patch('os.copy_file_range', side_effect=OSError(code, os.strerror(code)), create=True):
+                sparse_copy(self.src, dst)
+            self.assertSameContent(self.src, dst)
+
+    def test_other_errors_are_raised(self):
+        dst = os.path.join(self.dir, 'copy')
+        with mock.patch('os.copy_file_range', side_effect=OSError(errno.EIO, 'I/O error'), create=True):
+            with self.assertRaises(OSError):
+                sparse_copy(self.src, dst)
+
+    def test_clone_and_cache_across_file_systems(self):
+        # copy_file_range() fails like this between e.g. tmpfs and ext4.
+        exdev = OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        with mock.patch('os.copy_file_range', side_effect=exdev, create=True), \
+                mock.patch.object(qemuimage, 'reflink', side_effect=OSError(errno.EOPNOTSUPP, 'no reflink')):
+            strategy, _ = clone_image(self.src, os.path.join(self.dir, 'u-boot.rom'))
+            entry = ImageCache(os.path.join(self.dir, 'cache')).acquire(self.src, os.path.join(self.dir, 'ov'))
+        self.assertEqual(strategy, 'sparse-copy')
+        self.assertSameContent(self.src, os.path.join(self.dir, 'u-boot.rom'))
+        self.assertSameContent(self.src, entry)
+
+
+if __name__ == '__main__':
+    unittest.main()
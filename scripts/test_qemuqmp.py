@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Run with: python3 -m unittest discover -s scripts -p 'test_*.py'
+
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from qemuqmp import QmpError, QmpMonitor
+
+
+class FakeQmpServer(object):
+    """
+    Answers QMP commands on a unix socket like QEMU does. 'replies' maps a
+    command to its return value, or to an exception to reply with an error.
+    An event is sent before each reply so that the client has to tell them
+    apart, and the events listed in 'events' for a command after it.
+    """
+
+    def __init__(self, replies, events=None):
+        self.replies = replies
+        self.events = events or {}
+        self.commands = []
+        self.dir = tempfile.mkdtemp(prefix='qmp-test-')
+        self.path = os.path.join(self.dir, 'qmp.sock')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(1)
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _send(self, conn, msg):
+        conn.sendall(json.dumps(msg).encode() + b'\n')
+
+    def _serve(self):
+        conn, _ = self.sock.accept()
+        with conn:
+            self._send(conn, {'QMP': {'version': {}, 'capabilities': []}})
+            for line in conn.makefile('rb'):
+                msg = json.loads(line)
+                self.commands.append(msg)
+                self._send(conn, {'event': 'STOP', 'timestamp': {}})
+                reply = self.replies.get(msg['execute'], {})
+                if isinstance(reply, Exception):
+                    self._send(conn, {'id': msg['id'], 'error': {'class': 'GenericError', 'desc': str(reply)}})
+                else:
+                    self._send(conn, {'id': msg['id'], 'return': reply})
+                for event in self.events.get(msg['execute'], []):
+                    self._send(conn, {'event': event, 'timestamp': {}})
+
+    def close(self):
+        self.sock.close()
+        os.unlink(self.path)
+        os.rmdir(self.dir)
+
+
+class QmpMonitorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeQmpServer({
+            'query-status': {'status': 'running'},
+            'human-monitor-command': 'Error: No block device supports snapshots\r\n',
+            'cont': ValueError('guest is not stopped'),
+            'query-blockstats': [{'device': 'hd0', 'stats': {'rd_bytes': 512, 'wr_bytes': 0}}],
+            'query-cpus-fast': [{'cpu-index': 0}],
+        }, events={'system_powerdown': ['POWERDOWN', 'SHUTDOWN'], 'system_reset': ['RESET']})
+        self.monitor = QmpMonitor(self.server.path, timeout=5)
+
+    def tearDown(self):
+        self.monitor.close()
+        self.server.close()
+
+    def test_execute_matches_replies_to_commands(self):
+        self.assertEqual(self.monitor.execute('query-status'), {'status': 'running'})
+        self.assertEqual(self.server.commands[0]['execute'], 'qmp_capabilities')
+        self.assertEqual(self.server.commands[1]['execute'], 'query-status')
+        # The events that came in between were logged, not taken as replies.
+        self.assertEqual([e['event'] for e in self.monitor.client.event_log], ['STOP', 'STOP'])
+
+    def test_execute_raises_on_error(self):
+        with self.assertRaisesRegex(QmpError, 'cont: guest is not stopped'):
+            self.monitor.execute('cont')
+
+    def test_hmp_raises_on_error_output(self):
+        with self.assertRaisesRegex(QmpError, 'savevm boot: Error: No block device'):
+            self.monitor.hmp('savevm boot')
+        self.assertEqual(self.server.commands[-1]['arguments'], {'command-line': 'savevm boot'})
+
+    def test_wait_for_event(self):
+        self.monitor.execute('query-status')
+        # The STOP events sent so far are not waited for after clearing.
+        self.monitor.clear_events()
+        self.monitor.execute('system_reset')
+        self.assertEqual(self.monitor.wait_for_event(['RESET', 'SHUTDOWN'], timeout=5)['event'], 'RESET')
+        with self.assertRaises(asyncio.TimeoutError):
+            self.monitor.wait_for_event('SHUTDOWN', timeout=0.2)
+
+    def test_powerdown_waits_for_shutdown(self):
+        self.assertTrue(self.monitor.powerdown(timeout=5))
+        self.assertEqual(self.server.commands[-1]['execute'], 'system_powerdown')
+        self.assertIn('SHUTDOWN', [e['event'] for e in self.monitor.event_log])
+
+    def test_powerdown_times_out(self):
+        self.server.events = {}
+        self.assertFalse(self.monitor.powerdown(timeout=0.2))
+
+    def test_sample(self):
+        sample = self.monitor.sample()
+        self.assertEqual(sample['blockstats'][0]['stats']['rd_bytes'], 512)
+        self.assertEqual(sample['cpus'], [{'cpu-index': 0}])
+        self.assertEqual(self.monitor.status(), 'running')
+
+
+if __name__ == '__main__':
+    unittest.main()